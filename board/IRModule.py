@@ -1,10 +1,15 @@
 import microcontroller
 import pulseio
+from array import array
+from micropython import const
 from supervisor import ticks_ms
+from time import monotonic_ns
 from kmk.modules import Module
+from kmk.modules.holdtap import HoldTap, HoldTapKeyMeta
 from kmk.kmktime import ticks_diff
+from kmk.scheduler import cancel_task, create_task
 from kmk.handlers.sequences import send_string
-from kmk.keys import KC
+from kmk.keys import KC, make_argumented_key, make_key
 from kmk.types import KeySequenceMeta
 
 def decode(values, boundarySize = 50):
@@ -37,7 +42,11 @@ def decode(values, boundarySize = 50):
 
     possibilities = (len(markBoundaries)+1)*(len(spaceBoundaries)+1)
     if (possibilities > 10): # > 16):
-        return None # Give up.  This is too ugly a protocol.
+        # Too ugly a protocol for this: let the histogram have a go instead.
+        frameMarks = values[2::2]
+        frameSpaces = [-s for s in values[3::2]]
+        code = _fallback.decode(frameMarks, len(frameMarks), frameSpaces, len(frameSpaces))
+        return None if (code is None) else hex(code).upper()[2:]
 
     if (len(values) & 0x1): # if we have an odd number of values,
         # we can IGNORE the last mark IF there are not multiple mark timings.
@@ -70,180 +79,1265 @@ def decode(values, boundarySize = 50):
     outHex = hex(int("".join(encodedValues), possibilities)).upper()[2:]
     return outHex
 
+# decode() gives up when the timings fall into more than 10 mark/space combinations, which is
+# what air conditioner remotes (long frames, a second header or a trailer partway through) and
+# anything jittery enough to split a cluster look like.  This is the fallback for those: each
+# timing is counted into one of a fixed set of histogram bins (binUs wide, the last one catching
+# everything longer), runs of occupied bins become clusters, and the closest clusters are merged
+# until there are at most maxClusters marks and maxClusters spaces.  One pass over the frame plus
+# a fixed amount of work on the bins - no sorting, nothing allocated - and frames with more than
+# maxPulses values are turned down outright, so the cost per frame has a ceiling.
+_FALLBACK_BINS = const(64)
+
+class ClusterFallback:
+    def __init__(self, binUs: int = 100, maxClusters: int = 4, maxPulses: int = 512):
+        self.binUs = binUs
+        self.maxClusters = maxClusters
+        self.maxPulses = maxPulses
+        self.markCounts = array('H', [0] * _FALLBACK_BINS)
+        self.spaceCounts = array('H', [0] * _FALLBACK_BINS)
+        self.markIndex = bytearray(_FALLBACK_BINS) # bin -> cluster, for the frame being decoded
+        self.spaceIndex = bytearray(_FALLBACK_BINS)
+        self.lo = bytearray(_FALLBACK_BINS) # first and last bin of each cluster, scratch
+        self.hi = bytearray(_FALLBACK_BINS)
+
+    def _bin(self, value: int):
+        b = value // self.binUs
+        return b if (b < _FALLBACK_BINS) else _FALLBACK_BINS - 1
+
+    def _clusters(self, counts, index):
+        # Fills in index for every occupied bin, returns the number of clusters.
+        lo = self.lo
+        hi = self.hi
+        n = 0
+        for b in range(_FALLBACK_BINS):
+            if (counts[b] == 0):
+                continue
+            if (n) and (b - hi[n - 1] <= 2): # one empty bin is just jitter, not a new timing
+                hi[n - 1] = b
+            else:
+                lo[n] = b
+                hi[n] = b
+                n += 1
+        while (n > self.maxClusters):
+            best = 0
+            for i in range(1, n - 1):
+                if (lo[i + 1] - hi[i] < lo[best + 1] - hi[best]):
+                    best = i
+            hi[best] = hi[best + 1]
+            for j in range(best + 1, n - 1):
+                lo[j] = lo[j + 1]
+                hi[j] = hi[j + 1]
+            n -= 1
+        for i in range(n):
+            for b in range(lo[i], hi[i] + 1):
+                index[b] = i
+        return n
+
+    def decode(self, marks, nMarks: int, spaces, nSpaces: int):
+        # marks/spaces are the frame after the header, as positive durations.  Returns the code as
+        # an int, or None.
+        if (nMarks == 0) or (nMarks + nSpaces > self.maxPulses):
+            return None
+        markCounts = self.markCounts
+        spaceCounts = self.spaceCounts
+        for b in range(_FALLBACK_BINS):
+            markCounts[b] = 0
+            spaceCounts[b] = 0
+        for i in range(nMarks):
+            markCounts[self._bin(marks[i])] += 1
+        for i in range(nSpaces):
+            spaceCounts[self._bin(spaces[i])] += 1
+        markClusters = self._clusters(markCounts, self.markIndex)
+        spaceClusters = self._clusters(spaceCounts, self.spaceIndex) or 1
+        base = markClusters * spaceClusters
+        if (base <= 1):
+            return None
+        # Same idea as decode(): one digit per mark/space pair, a trailing mark paired with the
+        # shortest space.  The leading 1 keeps frames that only differ in length apart.
+        code = 1
+        for i in range(nMarks):
+            si = self.spaceIndex[self._bin(spaces[i])] if (i < nSpaces) else 0
+            code = code * base + self.markIndex[self._bin(marks[i])] * spaceClusters + si
+        return code
+
+_fallback = ClusterFallback()
+
+# decode() above needs the whole frame before it can do anything, so all of the work
+# (and all of the list/string garbage) lands on the main loop right when a button is pressed.
+# The streaming decoder does the same clustering, but does it as each pulse comes in:
+# marks and spaces are filed into preallocated arrays, the clusters (what decode() calls
+# "boundaries") are kept up to date on the fly, and the code is built up pair by pair.
+# If the clusters change shape (a new timing shows up, or two clusters merge) we re-encode
+# what we have so far from the arrays - that only happens a handful of times per frame,
+# usually in the first few bits - so by the time the end of the frame shows up the code is
+# already sitting there.  It gives exactly the same answers as decode() for frames of up to
+# maxPulses (256) marks.  Past that the arrays are full and the frame comes back as None, where
+# decode() would still cluster it; the histogram fallback turns down anything over 512 values
+# either way, so it's only frames decode() could cluster normally that differ.
+_MAX_CLUSTERS = const(16) # decode() gives up past 10 combinations anyway; a few spare in case clusters merge later.
+REPEAT = const(-1) # codes are never negative, so this can't collide with a real one.
+
+class StreamDecoder:
+    def __init__(self, maxPulses: int = 256, boundarySize: int = 50, protocols = ()):
+        self.boundarySize = boundarySize
+        self.protocols = protocols
+        self.maxPulses = maxPulses
+        self.marks = array('H', [0] * maxPulses)
+        self.spaces = array('H', [0] * maxPulses)
+        self.markLo = array('H', [0] * _MAX_CLUSTERS)
+        self.markHi = array('H', [0] * _MAX_CLUSTERS)
+        self.spaceLo = array('H', [0] * _MAX_CLUSTERS)
+        self.spaceHi = array('H', [0] * _MAX_CLUSTERS)
+        self.toggle = -1 # toggle bit of the last frame finished, for protocols that have one (RC5/RC6)
+        self.protocol = None # the protocol that decoded the last frame finished, if any
+        self.reset()
+
+    def reset(self):
+        self.count = 0 # Number of values in the frame, header included (same as len(values) for decode())
+        self.pendingSpace = 0 # Spaces only count once a mark follows them: a trailing space isn't part of the frame.
+        self.headerMark = 0
+        self.headerSpace = 0
+        self.nMarks = 0
+        self.nSpaces = 0
+        self.markClusters = 0
+        self.spaceClusters = 0
+        self.code = 0
+        self.dirty = False # the clusters changed since the code was last built
+        self.bad = False # a digit didn't fit the base (decode() would have thrown)
+        self.overflow = False # ran out of room for pulses
+        self.crowded = False # ran out of room for clusters: the histogram fallback gets the frame
+        self.known = False # the header looks like one of our protocols, so skip the clustering unless it turns out not to be
+
+    def __len__(self):
+        return self.count + (1 if self.pendingSpace else 0)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def start(self, headerMark: int):
+        self.reset()
+        self.count = 1
+        self.headerMark = headerMark
+
+    def feed(self, value: int):
+        # + for a mark, - for a space, same as the values handed to decode()
+        if (value < 0):
+            self.pendingSpace = -value
+            return
+        if (self.pendingSpace):
+            self._commitSpace(self.pendingSpace)
+            self.pendingSpace = 0
+        self.count += 1
+        if (self.nMarks == self.maxPulses):
+            self.overflow = True
+            return
+        self.marks[self.nMarks] = value
+        self.nMarks += 1
+        if (self.known):
+            return
+        n = self._cluster(self.markLo, self.markHi, self.markClusters, value)
+        if (n != self.markClusters):
+            self.markClusters = n
+            self.dirty = True
+
+    def _commitSpace(self, value: int):
+        self.count += 1
+        if (self.count == 2):
+            self.headerSpace = value
+            for protocol in self.protocols:
+                if (protocol.matches(self.headerMark, value)):
+                    self.known = True
+                    break
+            return
+        if (self.nSpaces == self.maxPulses) or (self.nSpaces >= self.nMarks):
+            self.overflow = True
+            return
+        self.spaces[self.nSpaces] = value
+        self.nSpaces += 1
+        if (self.known):
+            return
+        n = self._cluster(self.spaceLo, self.spaceHi, self.spaceClusters, value)
+        if (n != self.spaceClusters):
+            self.spaceClusters = n
+            self.dirty = True
+        # That's a full mark/space pair: encode it.
+        if (self.dirty):
+            if (self.base() <= 10):
+                self._recode()
+        else:
+            self._addDigit(self._digit(self.marks[self.nSpaces - 1], value))
+
+    def _cluster(self, lo, hi, n: int, value: int):
+        # Clusters are kept sorted; two timings belong to the same cluster if they're within
+        # boundarySize of each other, which is the same thing decode() finds by sorting.
+        # Returns the new number of clusters.
+        b = self.boundarySize
+        i = 0
+        while (i < n) and (hi[i] + b < value):
+            i += 1
+        if (i == n) or (value + b < lo[i]):
+            # A timing we haven't seen before: new cluster
+            if (n == _MAX_CLUSTERS):
+                self.crowded = True
+                return n
+            j = n
+            while (j > i):
+                lo[j] = lo[j - 1]
+                hi[j] = hi[j - 1]
+                j -= 1
+            lo[i] = value
+            hi[i] = value
+            return n + 1
+        if (value < lo[i]):
+            lo[i] = value
+        if (value > hi[i]):
+            hi[i] = value
+            # Growing upward might have closed the gap to the next cluster(s)
+            while (i + 1 < n) and (lo[i + 1] - hi[i] <= b):
+                if (hi[i + 1] > hi[i]):
+                    hi[i] = hi[i + 1]
+                for j in range(i + 1, n - 1):
+                    lo[j] = lo[j + 1]
+                    hi[j] = hi[j + 1]
+                n -= 1
+        return n
+
+    def base(self):
+        return (self.markClusters or 1) * (self.spaceClusters or 1)
+
+    def _markIndex(self, m: int):
+        mi = 0
+        while (mi + 1 < self.markClusters) and (self.markLo[mi + 1] <= m):
+            mi += 1
+        return mi
+
+    def _digit(self, m: int, s: int):
+        si = 0
+        while (si + 1 < self.spaceClusters) and (self.spaceLo[si + 1] <= s):
+            si += 1
+        # Same (lossy) combination decode() uses, so codes stay the same.
+        return self._markIndex(m) * (self.markClusters - 1) + si
+
+    def _addDigit(self, digit: int):
+        base = self.base()
+        if (digit >= 10): # decode() writes digits out in decimal, so this one is really two symbols
+            self._addDigit(digit // 10)
+            digit %= 10
+        if (digit >= base):
+            self.bad = True
+        self.code = self.code * base + digit
+
+    def _recluster(self):
+        # We skipped clustering because the header looked familiar, but no protocol took it.
+        self.markClusters = 0
+        self.spaceClusters = 0
+        for i in range(self.nMarks):
+            self.markClusters = self._cluster(self.markLo, self.markHi, self.markClusters, self.marks[i])
+        for i in range(self.nSpaces):
+            self.spaceClusters = self._cluster(self.spaceLo, self.spaceHi, self.spaceClusters, self.spaces[i])
+        self.dirty = True
+
+    def pulseAt(self, i: int):
+        # The frame as one list of durations (header included, alternating mark/space), for protocol decoders.
+        if (i == 0):
+            return self.headerMark
+        if (i == 1):
+            return self.headerSpace
+        i -= 2
+        return self.spaces[i >> 1] if (i & 1) else self.marks[i >> 1]
+
+    def _recode(self):
+        # The clusters changed under us: rebuild the code from the stored pairs.
+        self.code = 0
+        self.bad = False
+        self.dirty = False
+        for i in range(self.nSpaces):
+            self._addDigit(self._digit(self.marks[i], self.spaces[i]))
+
+    def finish(self):
+        # Returns the code as an int, REPEAT, or None if the frame couldn't be decoded, and
+        # gets ready for the next frame.
+        count = self.count
+        result = None
+        self.toggle = -1
+        self.protocol = None
+        if (self.known) and (not self.overflow):
+            for protocol in self.protocols:
+                if (protocol.matches(self.headerMark, self.headerSpace)):
+                    result = protocol.decode(self)
+                    if (result is not None):
+                        self.protocol = protocol
+                        self.reset()
+                        return result
+            self._recluster()
+        if (count == 0):
+            pass
+        elif (count <= 3): # if there are only 3 values, it's probably a "repeat" command.
+            result = REPEAT
+        elif (not self.overflow) and (not self.crowded) and (self.base() <= 10):
+            if (self.dirty):
+                self._recode()
+            if (self.nMarks > self.nSpaces) and (self.markClusters > 1):
+                # Odd number of values: the last mark only matters if there are multiple mark timings.
+                self._addDigit(self._markIndex(self.marks[self.nMarks - 1]) * (self.markClusters - 1))
+            if (not self.bad) and (self.base() > 1):
+                result = self.code
+        elif (not self.overflow):
+            # Too many timings for the clustering above, same as decode()
+            result = _fallback.decode(self.marks, self.nMarks, self.spaces, self.nSpaces)
+        self.reset()
+        return result
+
+# The original behaviour: collect the whole frame in a list and hand it to decode() at the end.
+class BatchDecoder:
+    def __init__(self):
+        self.values = []
+
+    def reset(self):
+        self.values.clear()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __bool__(self):
+        return len(self.values) > 0
+
+    def start(self, headerMark: int):
+        self.values.clear()
+        self.values.append(headerMark)
+
+    def feed(self, value: int):
+        self.values.append(value)
+
+    toggle = -1 # decode() doesn't know about toggle bits
+    protocol = None # ... or protocols
+
+    def finish(self):
+        values = self.values
+        if (len(values) and (values[-1] < 0)): # a trailing space isn't part of the frame
+            values.pop(-1)
+        result = decode(values)
+        values.clear()
+        if (result == "repeat"):
+            return REPEAT
+        return None if (result is None) else int(result, 16)
+
+def permutations(items):
+    # Every ordering of items (no itertools on CircuitPython).  Only for a handful of items at boot.
+    if (len(items) <= 1):
+        return [items]
+    out = []
+    for i in range(len(items)):
+        for rest in permutations(items[:i] + items[i + 1:]):
+            out.append([items[i]] + rest)
+    return out
+
+def hamming(a: int, b: int, limit: int):
+    # Number of bits that differ, but stop counting at limit (past that we don't care how many).
+    x = a ^ b
+    n = 0
+    while (x) and (n < limit):
+        x &= x - 1
+        n += 1
+    return n
+
+# Fixed-timing decoders for the common protocols.  When the frame's header (its first
+# mark and space) matches one of these, it's decoded in one pass with the exact bit count
+# the protocol calls for, and the result matches the manufacturer's numbering (bits taken in
+# the order they're sent).  If none of them take the frame, it goes to the clustering decoder.
+# To add your own protocol, subclass IRProtocol and add an instance to IR_Handler.protocols.
+# Toggle bits (RC5/RC6) are taken out of the code and reported in decoder.toggle instead, so
+# a held button keeps the same code and a fresh press of the same button can be told apart.
+def near(value: int, target: int):
+    # IR receivers stretch marks and shrink spaces a fair bit, so be generous.
+    return abs(value - target) <= (target >> 2) + 100
+
+class IRProtocol:
+    name = None
+    repeatPeriod = 0 # ms between frames while a button is held (start to start), if the protocol says
+    minFrames = 1 # how many frames to send for even the shortest press
+
+    def matches(self, headerMark: int, headerSpace: int):
+        # Has to be cheap: this is checked for every frame.
+        return False
+
+    def decode(self, decoder: StreamDecoder):
+        # Return the code (an int), REPEAT, or None if this frame isn't ours after all.
+        return None
+
+    def encode(self, code: int, toggle: int = 0, bits: int = 0):
+        # The other way, for IR_Transmitter: the mark/space durations (mark first, all positive)
+        # that decode() would turn back into this code.  None if we can't send.
+        return None
+
+    def repeatFrame(self):
+        # What to send while the button's held, if it isn't just the frame again.
+        return None
+
+# NEC (and NEC with 16-bit addresses) and Samsung32: a fixed mark, and a short or long
+# space for 0 or 1, LSB first, followed by a stop mark.
+class PulseDistanceProtocol(IRProtocol):
+    def __init__(self, name: str, headerMark: int, headerSpace: int, bits: int = 32, bitMark: int = 560, zeroSpace: int = 560, oneSpace: int = 1690, repeatSpace: int = 0, repeatPeriod: int = 108):
+        self.name = name
+        self.repeatPeriod = repeatPeriod
+        self.headerMark = headerMark
+        self.headerSpace = headerSpace
+        self.bits = bits
+        self.bitMark = bitMark
+        self.zeroSpace = zeroSpace
+        self.oneSpace = oneSpace
+        self.repeatSpace = repeatSpace
+
+    def matches(self, headerMark: int, headerSpace: int):
+        return near(headerMark, self.headerMark) and (
+            near(headerSpace, self.headerSpace)
+            or (self.repeatSpace and near(headerSpace, self.repeatSpace))
+        )
+
+    def decode(self, decoder: StreamDecoder):
+        if (self.repeatSpace and near(decoder.headerSpace, self.repeatSpace)):
+            # Repeat code: header, short space, one stop mark.
+            return REPEAT if (decoder.nMarks == 1) and (decoder.nSpaces == 0) else None
+        if (decoder.nMarks != self.bits + 1) or (decoder.nSpaces != self.bits):
+            return None
+        marks = decoder.marks
+        spaces = decoder.spaces
+        value = 0
+        for i in range(self.bits):
+            if (not near(marks[i], self.bitMark)):
+                return None
+            s = spaces[i]
+            if (near(s, self.oneSpace)):
+                value |= 1 << i
+            elif (not near(s, self.zeroSpace)):
+                return None
+        return value
+
+    def encode(self, code: int, toggle: int = 0, bits: int = 0):
+        out = [self.headerMark, self.headerSpace]
+        for i in range(self.bits):
+            out.append(self.bitMark)
+            out.append(self.oneSpace if (code >> i) & 1 else self.zeroSpace)
+        out.append(self.bitMark)
+        return out
+
+    def repeatFrame(self):
+        return [self.headerMark, self.repeatSpace, self.bitMark] if self.repeatSpace else None
+
+# Sony: 2.4ms header, then a long (1) or short (0) mark per bit, LSB first: 7 bit command
+# then 5, 8 or 13 bits of address.  There's no stop bit, the last space runs into the gap.
+class SIRCProtocol(IRProtocol):
+    name = "SIRC"
+    repeatPeriod = 45
+    minFrames = 3 # Sony devices want to see a code three times
+
+    def matches(self, headerMark: int, headerSpace: int):
+        return near(headerMark, 2400) and near(headerSpace, 600)
+
+    def decode(self, decoder: StreamDecoder):
+        bits = decoder.nMarks
+        if ((bits != 12) and (bits != 15) and (bits != 20)) or (decoder.nSpaces != bits - 1):
+            return None
+        marks = decoder.marks
+        spaces = decoder.spaces
+        value = 0
+        for i in range(bits):
+            m = marks[i]
+            if (near(m, 1200)):
+                value |= 1 << i
+            elif (not near(m, 600)):
+                return None
+            if (i < bits - 1) and (not near(spaces[i], 600)):
+                return None
+        return value
+
+    def encode(self, code: int, toggle: int = 0, bits: int = 0):
+        if (not bits): # the shortest length it fits in
+            bits = 12 if (code < (1 << 12)) else (15 if (code < (1 << 15)) else 20)
+        out = [2400, 600]
+        for i in range(bits):
+            out.append(1200 if (code >> i) & 1 else 600)
+            out.append(600)
+        out.pop() # no space after the last bit
+        return out
+
+# Manchester-coded protocols: lay the frame out as one level per half-bit time, then read
+# the bits off at fixed positions.
+class ManchesterProtocol(IRProtocol):
+    unit = 0
+    maxUnits = 2 # longest a single mark/space can be, in units
+
+    def __init__(self):
+        self.levels = bytearray(96)
+
+    def expand(self, decoder: StreamDecoder, first: int, n: int):
+        # Fill self.levels from index n with the levels of the frame's pulses (starting at pulse
+        # `first`).  Returns the number of levels filled in, or -1 if something doesn't fit.
+        levels = self.levels
+        unit = self.unit
+        for i in range(first, decoder.count):
+            units = (decoder.pulseAt(i) + (unit >> 1)) // unit
+            if (units < 1) or (units > self.maxUnits) or (n + units > len(levels)):
+                return -1
+            level = 0 if (i & 1) else 1
+            for _ in range(units):
+                levels[n] = level
+                n += 1
+        return n
+
+    def bit(self, at: int, halfWidth: int = 1):
+        # Returns the level of the first half, or -1 if the halves don't differ (not Manchester).
+        levels = self.levels
+        first = levels[at]
+        return first if (first != levels[at + halfWidth]) else -1
+
+    def pulses(self, levels):
+        # The reverse of expand(): one level per half-bit -> mark/space durations, without the
+        # idle (space) at either end.
+        unit = self.unit
+        out = []
+        current = -1
+        run = 0
+        for level in levels:
+            if (level == current):
+                run += 1
+                continue
+            if (run) and (out or current == 1):
+                out.append(run * unit)
+            current = level
+            run = 1
+        if (current == 1):
+            out.append(run * unit)
+        return out
+
+# RC5: 889us half-bits, 14 bits MSB first: start, field (inverted command bit 6 in RC5X), toggle,
+# 5 bit address, 6 bit command.  A 1 is space-then-mark, so the first half of the start bit is
+# never seen, and a trailing 0 loses its last half to the gap.
+class RC5Protocol(ManchesterProtocol):
+    name = "RC5"
+    repeatPeriod = 114
+    unit = 889
+
+    def matches(self, headerMark: int, headerSpace: int):
+        return (near(headerMark, 889) or near(headerMark, 1778)) and (near(headerSpace, 889) or near(headerSpace, 1778))
+
+    def decode(self, decoder: StreamDecoder):
+        self.levels[0] = 0
+        n = self.expand(decoder, 0, 1)
+        if (n == 27):
+            self.levels[27] = 0
+        elif (n != 28):
+            return None
+        value = 0
+        for i in range(14):
+            b = self.bit(2 * i)
+            if (b < 0):
+                return None
+            value = (value << 1) | (1 - b) # 1 is space-then-mark
+        if (not (value & 0x2000)):
+            return None
+        decoder.toggle = (value >> 11) & 1
+        return value & ~0x800
+
+    def encode(self, code: int, toggle: int = 0, bits: int = 0):
+        value = (code & ~0x800) | 0x2000 | (toggle << 11)
+        levels = []
+        for i in range(13, -1, -1):
+            levels += (0, 1) if (value >> i) & 1 else (1, 0)
+        return self.pulses(levels)
+
+# RC6: 2.67ms/889us leader, a start bit, 3 mode bits, a double-width trailer (toggle) bit, then
+# 16 bits (mode 0) or 32 bits (mode 6, e.g. MCE remotes) of data.  444us half-bits, MSB first,
+# and a 1 is mark-then-space.
+class RC6Protocol(ManchesterProtocol):
+    name = "RC6"
+    repeatPeriod = 107
+    unit = 444
+    maxUnits = 3 # the trailer bit's halves are double width
+
+    def matches(self, headerMark: int, headerSpace: int):
+        return near(headerMark, 2666) and near(headerSpace, 889)
+
+    def decode(self, decoder: StreamDecoder):
+        n = self.expand(decoder, 2, 0)
+        if (n < 12) or (self.bit(0) != 1):
+            return None
+        mode = 0
+        for i in range(3):
+            b = self.bit(2 + 2 * i)
+            if (b < 0):
+                return None
+            mode = (mode << 1) | b
+        toggle = self.bit(8, 2)
+        if (toggle < 0):
+            return None
+        if (mode == 0):
+            bits = 16
+        elif (mode == 6):
+            bits = 32
+        else:
+            return None
+        end = 12 + 2 * bits
+        if (n == end - 1):
+            self.levels[n] = 0 # a trailing 1 loses its last half to the gap
+        elif (n != end):
+            return None
+        value = 0
+        for i in range(bits):
+            b = self.bit(12 + 2 * i)
+            if (b < 0):
+                return None
+            value = (value << 1) | b
+        decoder.toggle = toggle
+        return (mode << bits) | value
+
+    def encode(self, code: int, toggle: int = 0, bits: int = 0):
+        mode = code >> 32
+        bits = 32 if mode else 16
+        levels = [1, 1, 1, 1, 1, 1, 0, 0, 1, 0] # leader, start bit
+        for i in range(2, -1, -1):
+            levels += (1, 0) if (mode >> i) & 1 else (0, 1)
+        levels += (1, 1, 0, 0) if toggle else (0, 0, 1, 1)
+        for i in range(bits - 1, -1, -1):
+            levels += (1, 0) if (code >> i) & 1 else (0, 1)
+        return self.pulses(levels)
+
+# The built-in protocols, in the order they're tried.  Off by default (the codes they give are
+# different from what the clustering decoder gives, so existing maps would need updating):
+# set IR_Handler.protocols = PROTOCOLS to turn them on.
+PROTOCOLS = (
+    PulseDistanceProtocol("NEC", 9000, 4500, repeatSpace=2250),
+    PulseDistanceProtocol("Samsung32", 4500, 4500),
+    SIRCProtocol(),
+    RC5Protocol(),
+    RC6Protocol(),
+)
+
 # Here I'm shimming the pulseio class with a couple changes:
-# 1) It doesn't just return a pulse time, it also returns whether or not the pulse was a mark or space
+# 1) It doesn't just return a pulse time, it also tells you whether the pulse was a mark or a space:
+# marks come back positive, spaces negative.
 # (This works until the pulseio is paused or restarted or whatever, which I haven't implemented)
 # 2) The way the library works, when started it'll always wait for the first non-idle pulse
 # That's fine EXCEPT that my decode watches for a long space to mark the start of a signal
 # This will normally happen after a transmission, but when it's just started it won't.
 # So I've added a "previous value" placeholder to make this more convenient
+# 3) Going to PulseIn for every look at a pulse is slow, so drain() empties it into our own
+# ring buffer in one go (once per service()), and everything else - indexing, popleft, the
+# start/end checks - works on that buffer without making any tuples.
 class pulse:
     def __init__(self, pin: microcontroller.Pin, maxlen: int = 2, idle_state: bool = False):
         self._pulse = pulseio.PulseIn(pin, maxlen, idle_state)
-        self.isMark = True
-        self.prevValue = (30000, not self.isMark) # the previous value we return was a space of 30ms
+        self.isMark = True # whether the next value we drain from PulseIn is a mark
+        self.prevValue = -30000 # the previous value we return was a space of 30ms
+
+        self.size = maxlen
+        self.buffer = array('i', [0] * maxlen)
+        self.head = 0 # index of the oldest value in the buffer
+        self.length = 0
 
-        self.queueUs = 0
-        self.queueUsLen = 0
+        self.queueUs = 0 # total duration of everything in the buffer, kept up to date by drain() and popleft()
+        self.overflow = 0 # times drain() couldn't take everything because the buffer was full
+
+        # Glitch filter: a pulse shorter than glitchUs (a flicker from a lamp, say) can't be part of a
+        # real frame, so it and the pulse after it are merged into the one before: mark, 40us space,
+        # mark becomes one long mark.  That means holding on to the latest pulse until we know the
+        # next one isn't a glitch (see flush()).  0 turns it off.
+        self.glitchUs = 0
+        self.held = 0 # the latest pulse, signed, not in the buffer yet
+        self.glitch = 0 # a short pulse waiting to be merged into held
+        self.merged = 0 # how many glitches we've taken out
+    def drain(self):
+        # Move everything PulseIn has (or as much as we have room for) into the buffer.
+        source = self._pulse
+        waiting = len(source)
+        n = min(waiting, self.size - self.length)
+        if (n < waiting):
+            self.overflow += 1
+        if (not n):
+            return 0
+        if (self.glitchUs):
+            return self.drainFiltered(n)
+        buffer = self.buffer
+        size = self.size
+        tail = self.head + self.length
+        if (tail >= size):
+            tail -= size
+        isMark = self.isMark
+        queueUs = self.queueUs
+        for _ in range(n):
+            value = source.popleft()
+            queueUs += value
+            buffer[tail] = value if isMark else -value
+            isMark = not isMark
+            tail += 1
+            if (tail == size):
+                tail = 0
+        self.isMark = isMark
+        self.queueUs = queueUs
+        self.length += n
+        return n
+    def drainFiltered(self, n: int):
+        # drain(), with the glitch filter.  Writes at most n values, so there's always room.
+        source = self._pulse
+        buffer = self.buffer
+        size = self.size
+        tail = self.head + self.length
+        if (tail >= size):
+            tail -= size
+        glitchUs = self.glitchUs
+        isMark = self.isMark
+        held = self.held
+        glitch = self.glitch
+        written = 0
+        queueUs = self.queueUs
+        for _ in range(n):
+            value = source.popleft()
+            if (glitch): # the pulse after a glitch: same kind as held, so it all becomes one
+                held += (glitch + value) if (held > 0) else -(glitch + value)
+                glitch = 0
+                self.merged += 1
+            elif (held) and (value < glitchUs):
+                glitch = value
+            else:
+                if (held):
+                    buffer[tail] = held
+                    queueUs += held if (held > 0) else -held
+                    written += 1
+                    tail += 1
+                    if (tail == size):
+                        tail = 0
+                held = value if isMark else -value
+            isMark = not isMark
+        self.isMark = isMark
+        self.held = held
+        self.glitch = glitch
+        self.queueUs = queueUs
+        self.length += written
+        return n
+    def flush(self):
+        # The line's been quiet a while, so whatever we're holding can't be followed by a glitch: let
+        # it through.  (Unless a glitch is already waiting: then the pulse after it is still going.)
+        held = self.held
+        if (not held) or (self.glitch) or (self.length == self.size):
+            return False
+        tail = self.head + self.length
+        if (tail >= self.size):
+            tail -= self.size
+        self.buffer[tail] = held
+        self.queueUs += held if (held > 0) else -held
+        self.length += 1
+        self.held = 0
+        return True
     def popleft(self):
-        self.prevValue = self[0]
-        self._pulse.popleft()
-        self.isMark = not self.isMark
-        if (self.queueUsLen):
-            self.queueUs -= self.prevValue[0]
-            self.queueUsLen -= 1
-        return self.prevValue
+        value = self.buffer[self.head]
+        self.head += 1
+        if (self.head == self.size):
+            self.head = 0
+        self.length -= 1
+        self.prevValue = value
+        self.queueUs -= value if (value > 0) else -value
+        return value
     def __len__(self):
-        return len(self._pulse)
+        return self.length
     def __getitem__(self, index: int):
-        toReturn = self._pulse[index]
-        markCopy = self.isMark
-        if (index & (0x1)):
-            markCopy = not markCopy
-        return (toReturn, markCopy)
+        # Peek at a buffered value without removing it: + for a mark, - for a space.
+        index += self.head
+        if (index >= self.size):
+            index -= self.size
+        return self.buffer[index]
     def __bool__(self):
-        return len(self)>0
+        return self.length > 0
     def isEnd(self):
         # We're defining the end of sequence as either:
         # (A) A long space (10ms+, but might need to drop this to ~5ms: I'd be worried about going lower)
         # or (B) A sorta-long space (2-3ms) followed by a sorta-long mark (2-3ms), as might happen
         # in a 20-bit worst-case sony message OR RC-6 which only has a signal-free time of 2.7ms
         # followed by a header of 2.7ms (at least, in spec... in practice might be more blank time)
-        myLen = len(self)
-        p0 = None if not myLen else self[0]
+        # For (B), None means it depends on a space that hasn't come in yet (see newFrameAt).
+        if (not self.length):
+            return False
+        p0 = self[0]
+        if (p0 >= 0): # not a space
+            return False
+        if (p0 <= -10000): # the space is 10ms or longer, which should be enough to guarantee it's the end.  Might need to fiddle.
+            return True
         return (
-            (p0 is not None)
-            and (not p0[1]) # if the pulse we're returning is a space
-            and (
-                (
-                    p0[0] >= 10000 # the space is 10ms or longer, which should be enough to guarantee it's the end.  Might need to fiddle.
-                ) or (
-                    (p0[0] >= 2300) # and it's at least 2.3ms (settling on that because the space could be as little as 2.6ms, plus some margin for safety)
-                    and (myLen > 1) # and there's another item in the queue
-                    and (self[1][0] >= 2100) # and it's a header (at least 2.1ms, since minimum header is 2.4ms in sony or 2.6ms in RC6 which are our trouble protocols)
-                )
-            )
+            (p0 <= -2300) # and it's at least 2.3ms (settling on that because the space could be as little as 2.6ms, plus some margin for safety)
+            and (self.length > 1) # and there's another item in the queue
+            and (self[1] >= 2100) # and it's a header (at least 2.1ms, since minimum header is 2.4ms in sony or 2.6ms in RC6 which are our trouble protocols)
+            and self.newFrameAt(1)
         )
+    def newFrameAt(self, index: int):
+        # The header mark at index came after a short gap: is it a new frame, or the next section of
+        # this one?  Sony and RC-6 (what the short gap rule is for) follow their header mark with a
+        # short space, 600 or 889us, where air conditioners that send one long frame in sections
+        # leave 1.7ms or more - and their gap between sections can be as short as Sony's between
+        # frames.  None until that space is in.
+        if (index + 1 >= self.length):
+            return None
+        return self[index + 1] > -1300
+    def skipToStart(self):
+        # Throw away everything up to the next frame start (see isStart), or all of it if there isn't one.
+        n = 0
+        while (self.length) and (not self.isStart()):
+            self.popleft()
+            n += 1
+        return n
     def isStart(self):
         # Either the previous value was a space of 10ms or longer, OR
         # the previous value was a space of 2.3ms or longer AND we now
         # have a mark of 2.1ms or longer.
+        # (The second one's subject to newFrameAt, like isEnd, so it can be None too.)
+        prevValue = self.prevValue
+        if (not self.length) or (prevValue >= 0): # nothing to return, or the previous item wasn't a space
+            return False
+        if (prevValue <= -10000): # that space was 10ms or longer
+            return True
         return (
-            (len(self)) # We have an item to return
-            and (not self.prevValue[1]) # previous item was a space
-            and (
-                (self.prevValue[0] >= 10000) # that space was 10ms or longer
-                or (
-                    (self.prevValue[0] >= 2300) # that space was 2.3ms or longer AND
-                    and (self[0][0] >= 2100) # the value we have now is at least 2.1ms or longer
-                )
-            )
+            (prevValue <= -2300) # that space was 2.3ms or longer AND
+            and (self[0] >= 2100) # the value we have now is at least 2.1ms or longer
+            and self.newFrameAt(0)
         )
     def queueMs(self): # might use this for timing functions to see how "far behind" we (VERY ROUGHLY) are
-        # This won't account for whatever pulse we're currently recording and haven't reached the end of.
-        totalMicros = self.queueUs
-        lenNow = len(self)
-        while (lenNow != self.queueUsLen):
-            for i in range(self.queueUsLen, lenNow):
-                totalMicros += self[i][0]
-                self.queueUsLen += 1
-            lenNow = len(self)
-        return (totalMicros+500)//1000
+        # This won't account for whatever pulse we're currently recording and haven't reached the end of,
+        # or anything still sitting in PulseIn that hasn't been drained yet.
+        return (self.queueUs+500)//1000
+
+# What ir.service() hands back: a fixed-size queue of (kind, code) events, kept in preallocated
+# lists so nothing is allocated per event.  popleft() returns the code and leaves the kind ("press"
+# or "release") in .kind, and when the frame behind it finished arriving in .ticks.  If it fills
+# up (nobody's calling service()), the oldest event is dropped and counted in overflow: losing a
+# press is better than losing the release after it.
+class eventQueue:
+    def __init__(self, size: int = 16):
+        self.size = size
+        self.kinds = [None] * size
+        self.codes = [0] * size
+        self.stamps = [0] * size
+        self.head = 0
+        self.length = 0
+        self.kind = None
+        self.ticks = 0
+        self.overflow = 0
+    def append(self, kind: str, code: int, ticks: int = 0):
+        if (self.length == self.size):
+            self.popleft()
+            self.overflow += 1
+        tail = self.head + self.length
+        if (tail >= self.size):
+            tail -= self.size
+        self.kinds[tail] = kind
+        self.codes[tail] = code
+        self.stamps[tail] = ticks
+        self.length += 1
+    def popleft(self):
+        head = self.head
+        self.kind = self.kinds[head]
+        self.ticks = self.stamps[head]
+        code = self.codes[head]
+        self.head = head + 1 if (head + 1 < self.size) else 0
+        self.length -= 1
+        return code
+    def __len__(self):
+        return self.length
+    def __bool__(self):
+        return self.length > 0
+
+# For IR_Handler.measureLatency: counts of values in power-of-two buckets (under 1, under 2, under
+# 4, ... and everything past the last), so it never grows however long it runs.
+class histogram:
+    def __init__(self, name: str, unit: str, buckets: int = 10):
+        self.name = name
+        self.unit = unit
+        self.counts = array('L', [0] * buckets)
+        self.total = 0
+        self.largest = 0
+    def add(self, value: int):
+        i = 0
+        last = len(self.counts) - 1
+        while (i < last) and (value >= (1 << i)):
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        if (value > self.largest):
+            self.largest = value
+    def clear(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.total = 0
+        self.largest = 0
+    def report(self):
+        out = "%s (%s, %d, max %d):" % (self.name, self.unit, self.total, self.largest)
+        last = len(self.counts) - 1
+        for i, count in enumerate(self.counts):
+            if (count):
+                out += " %s%d:%d" % ("<" if (i < last) else ">=", 1 << i if (i < last) else 1 << (i - 1), count)
+        return out
 
 # Singleton
 class ir():
-    def __init__(self, pin: microcontroller.Pin):
-        self.events = []
+    def __init__(self, pin: microcontroller.Pin, streaming: bool = True, protocols = (), glitchUs: int = 150):
+        self.events = eventQueue()
 
         self._pulse = pulse(pin, maxlen=1000, idle_state=True)
-        self.pulses = []
+        self._pulse.glitchUs = glitchUs
+        # The streaming decoder works on the frame as it comes in; the batch decoder is the
+        # original decode()-at-the-end behaviour.  Both give the same codes.  Protocol decoders
+        # need the streaming decoder's buffers, so they're only used in streaming mode.
+        self.decoder = StreamDecoder(protocols=protocols) if streaming else BatchDecoder()
+        self.lastToggle = -1
+        self.resolveCode = None # optional: maps a decoded code onto the one we should treat it as (see IR_Handler.fuzzyDistance)
+        self.owner = self # the receiver that keeps track of what's pressed and sends the events
+        self.duplicateMs = 20 # frames of the same code starting closer together than this are the same frame
+        # ... give or take how stale the two start stamps can be.  A receiver only reads its pulses
+        # when it's serviced, so a frame's start is stamped up to one service gap late - and with
+        # several receivers taking turns, that's a loop per receiver.  IR_Handler turns this on
+        # when there's more than one.
+        self.trackSlack = False
+        self.lastServiceTicks = ticks_ms()
+        self.serviceGap = 0 # ms since the service() before this one (kept when trackSlack is on)
+        self.startSlack = 0 # how late pulsesStart might be
+        self.lastDecodeSlack = 0 # and the same for lastDecodeStartTicks
         self.pulsesStart = 0
         self.currentValue = None
+        self.backlogThreshold = 100 # with more than this many pulses waiting, we work out when they actually arrived
+        self.backlogHits = 0 # how many times we've been that far behind: if this climbs, look at maxlen / loop load
+        # At most pulseBudget pulses are worked through per service() call (0 = no limit), so a held
+        # button in a noisy room can't hold up the key scan.  What happens to the rest depends on
+        # dropPolicy:
+        #   "full"   - it waits for the next call; nothing's lost unless PulseIn itself overflows
+        #   "skip"   - the frame we're part way through is abandoned, and the next call starts on the
+        #              next frame that comes in (so the budget needs to be bigger than a frame)
+        #   "oldest" - whole frames are thrown away from the front (the one we're part way through
+        #              first) until what's left fits in the budget: we decode the newest frames
+        # Frames thrown away are counted in droppedFrames.
+        self.pulseBudget = 100
+        self.dropPolicy = "full"
+        self.droppedFrames = 0
         self.lastDecodeStartTicks = 0 # Naming is hard, didn't want to make it too long: this variable holds the tim when we STARTED receiving the most recent successfuly-decoded signal
+        self.lastDecodeTicks = 0 # and this one is when we finished decoding it
+        self.lastPulseTicks = 0 # when we last got anything from PulseIn
+        self.frameEndTicks = 0 # (roughly) when the last pulse of the frame we're decoding came in
+        self.decodeTimes = None # if set (a histogram), how long each decode takes goes in here, in us
 
-    def decodeHandler(self):
-        # move self.pulses and self.pulsesStart into a safe place so they can't get overwritten.
-        # Decode the pulses to a value: update currentValue, lastDecodeStartTicks, and startTime (if necessary)
-        # Emit value
+        # Release timing.  While a button is held, the remote resends every repeatPeriod ms (the
+        # protocol's figure to start with, then the shortest gap we actually see between frame
+        # starts), and we let go releasePercent% of that after the last frame.  If we don't know the
+        # period yet, it's releaseTimeout.
+        self.releaseTimeout = 300
+        self.releasePercent = 150
+        self.repeatPeriod = 0
+        self.releaseAfter = self.releaseTimeout
+        self.maxFrameMs = 200 # a frame that takes longer than this to come in gets thrown away
+        self.endGapMs = 10 # a space this long ends a frame, so once the line's been quiet this long we can decode
 
-        newVal = decode(self.pulses)
-        self.lastDecodeStartTicks = self.pulsesStart
+        # Frames that can't be from a remote are thrown away before decoding: anything longer than a
+        # repeat frame but shorter than minFramePulses, or where the longest mark (or space) is more
+        # than maxPulseRatio times the shortest.  Remotes only use two or three lengths of each, a
+        # couple of times apart; noise is all over the place.  The header isn't counted, and neither
+        # is the last space (it might be the gap before the next frame).
+        self.minFramePulses = 12
+        self.maxPulseRatio = 6 # 0 turns this off
+        self.rejectedFrames = 0
+        self.minMark = 0
+        self.maxMark = 0
+        self.minSpace = 0
+        self.maxSpace = 0
+        self.lastSpace = 0
+
+    def decodeHandler(self, ticksNow: int):
+        # Finish decoding the frame we've been feeding the decoder (which also gets it ready for the next one).
+        # Decode the pulses to a value, and pass it on to frameDecoded to update what's pressed.
+
+        if (not self.plausible()):
+            self.decoder.reset()
+            self.rejectedFrames += 1
+            return
+        if (self.decodeTimes is not None):
+            started = monotonic_ns()
+        newVal = self.decoder.finish()
+        if (self.resolveCode is not None) and (newVal is not None) and (newVal != REPEAT):
+            newVal = self.resolveCode(newVal) # done before comparing to currentValue, so a garbled frame mid-hold doesn't re-press
+        if (self.decodeTimes is not None):
+            self.decodeTimes.add((monotonic_ns() - started) // 1000)
+        self.owner.frameDecoded(newVal, self.decoder.toggle, self.decoder.protocol, self.pulsesStart, ticksNow, self.frameEndTicks, self.startSlack)
+
+    def frameDecoded(self, newVal, toggle: int, protocol, startTicks: int, ticksNow: int, endTicks: int, slack: int = 0):
+        # Work out what a decoded frame means for the button being held (on the receiver that owns
+        # the press state: itself, or the first one if there are several, see IR_Handler.pins).
+        if (newVal is None):
+            return # Couldn't make sense of it: don't press anything, and don't count it as the button still being held.
+        window = self.duplicateMs + slack + self.lastDecodeSlack
+        if (self.repeatPeriod) and (window > self.repeatPeriod * 3 // 4): # never so wide it swallows real repeats
+            window = self.repeatPeriod * 3 // 4
+        if (self.currentValue is not None) and ((newVal == REPEAT) or (newVal == self.currentValue)) and (ticks_diff(startTicks, self.lastDecodeStartTicks) < window):
+            # Another receiver's copy of a frame we've already had.
+            self.lastDecodeTicks = ticksNow
+            return
+        # A toggle bit that flipped means the button was let go and pressed again, even if the
+        # frames came in close enough together to look like it was held.
+        toggled = (toggle >= 0) and (self.lastToggle >= 0) and (toggle != self.lastToggle)
+        if (newVal == REPEAT):
+            if (self.currentValue is None):
+                return # A repeat of something we didn't catch: nothing to do.
+        else:
+            self.lastToggle = toggle
+        if (newVal == REPEAT or newVal == self.currentValue) and (not toggled):
+            self.learnPeriod(ticks_diff(startTicks, self.lastDecodeStartTicks))
+        self.lastDecodeStartTicks = startTicks
+        self.lastDecodeSlack = slack
+        self.lastDecodeTicks = ticksNow
 
         newPress = False
-        if (self.currentValue):
-            if (newVal == "repeat" or newVal == self.currentValue):
+        if (self.currentValue is not None): # codes are ints now, and 0 is a perfectly good code
+            if (newVal == REPEAT or (newVal == self.currentValue and not toggled)):
                 # it's the same value, no change
                 pass
             else:
                 # we had an old value, now we have a new value
-                self.events.append(("release", self.currentValue))
+                self.events.append("release", self.currentValue, endTicks)
                 newPress = True
         else:
             # we did not have an old value, but we now have a value.
             newPress = True
         if (newPress):
             self.currentValue = newVal
-            self.events.append(("press", self.currentValue))
+            self.events.append("press", self.currentValue, endTicks)
+            self.repeatPeriod = 0
+            self.learnPeriod(protocol.repeatPeriod if protocol is not None else 0)
+
+    def plausible(self):
+        count = len(self.decoder)
+        if (count <= 3) or (not self.maxPulseRatio): # a repeat frame (or nothing), or the check's turned off
+            return True
+        if (count < self.minFramePulses):
+            return False
+        ratio = self.maxPulseRatio
+        return (self.maxMark <= self.minMark * ratio) and (self.maxSpace <= self.minSpace * ratio)
 
-        self.pulses = []
+    def learnPeriod(self, interval: int):
+        # Keep the shortest start-to-start gap we've seen for this button (a longer one just means
+        # a frame got lost), and base the release deadline on it.
+        if (interval > 0) and ((self.repeatPeriod == 0) or (interval < self.repeatPeriod)):
+            self.repeatPeriod = interval
+        if (self.repeatPeriod):
+            self.releaseAfter = min(self.repeatPeriod * self.releasePercent // 100, self.releaseTimeout)
+        else:
+            self.releaseAfter = self.releaseTimeout
 
     def readPulses(self, ticksNow: int):
+        decoder = self.decoder
+        if (self._pulse.drain()):
+            self.lastPulseTicks = ticksNow
+        elif (ticks_diff(ticksNow, self.lastPulseTicks) > self.endGapMs):
+            if (self._pulse.flush()): # let the glitch filter's last pulse through first
+                pass
+            elif (decoder) and (not self._pulse):
+                # Nothing new for a while: we're in the space after the last mark, and PulseIn won't
+                # hand that over until the next mark starts, so don't wait for it.
+                self.frameEndTicks = self.lastPulseTicks
+                self.decodeHandler(ticksNow)
+                return
+        if (len(self._pulse) > self.backlogThreshold):
+            self.backlogHits += 1
+        budget = self.pulseBudget
+        if (budget) and (self.dropPolicy == "oldest"):
+            while (len(self._pulse) > budget):
+                if (decoder):
+                    decoder.reset()
+                    self.droppedFrames += 1
+                if (self._pulse.isStart()):
+                    self._pulse.popleft()
+                    self.droppedFrames += 1
+                self._pulse.skipToStart()
+        count = 0
         while (self._pulse):
-            # if, at any point, the current values would "expire" (took longer than 200ms to receive)
+            if (count == budget) and (budget):
+                if (self.dropPolicy == "skip"):
+                    if (decoder):
+                        decoder.reset()
+                        self.droppedFrames += 1
+                    self._pulse.skipToStart()
+                break
+            count += 1
+            # if, at any point, the current values would "expire" (took longer than maxFrameMs to receive)
             # we need to make sure we restart the pulses list
-            ticksThen = ticks_diff(ticksNow, self._pulse.queueMs()) if len(self._pulse) > 100 else ticksNow # if we have too much backed up, MOVE ON.
-            if (ticks_diff(ticksThen, self.pulsesStart) > 200): # Greater than 200ms.  Discard current pulses, restart.
-                self.pulses = []
-            if (self._pulse.isStart()): # If we're currently on the start, we might have accidentally read an end in.  Start implies it's a mark.
-                if (
-                    (len(self.pulses)) # if we had pulses
-                    and (self.pulses[-1] < 0) # and the last one was a space
-                ):
-                    self.pulses.pop(-1)
-                if (len(self.pulses)):
-                    self.decodeHandler() # should move the self.pulses to another place (to start decoding) and clear it for new entries
+            ticksThen = ticks_diff(ticksNow, self._pulse.queueMs()) if len(self._pulse) > self.backlogThreshold else ticksNow # if we have too much backed up, MOVE ON.
+            if (ticks_diff(ticksThen, self.pulsesStart) > self.maxFrameMs): # Too long.  Discard current pulses, restart.
+                decoder.reset()
+            start = self._pulse.isStart()
+            end = False if (start) else self._pulse.isEnd()
+            if (start is None) or (end is None):
+                # A header after a short gap, and whether it's a new frame depends on the space after
+                # it (see pulse.newFrameAt): wait for that.  If the line's gone quiet there won't be
+                # one, so take it as a new frame, as we would have anyway.
+                if (ticks_diff(ticksNow, self.lastPulseTicks) <= self.endGapMs):
+                    break
+                start = start is None
+                end = end is None
+            if (start): # If we're currently on the start, we might have accidentally read an end in.  Start implies it's a mark.
+                if (decoder): # the decoder drops a trailing space on its own
+                    self.frameEndTicks = ticksThen
+                    self.decodeHandler(ticksThen) # finishes the frame and clears the decoder for new entries
+                self.startSlack = self.serviceGap
                 self.pulsesStart = ticksThen #ticks_diff(ticksNow, self._pulse.queueMs()) # start the timer back when we would have received the start pulse... roughly. # Avoid calling queueMs again
-                readPulse = self._pulse.popleft()
-                self.pulses.append(readPulse[0]) # only care about the value, not the "isMark"
-            elif (self._pulse.isEnd()): # Great, we're at the end of the sequence!  Move on to decode. Note that this implies the pulse[0] is a space.
-                if (len(self.pulses)):
-                    self.decodeHandler()
+                decoder.start(self._pulse.popleft()) # starts are always marks, so this is positive
+                self.minMark = self.minSpace = 1000000
+                self.maxMark = self.maxSpace = self.lastSpace = 0
+            elif (end): # Great, we're at the end of the sequence!  Move on to decode. Note that this implies the pulse[0] is a space.
+                if (decoder):
+                    self.frameEndTicks = ticksThen
+                    self.decodeHandler(ticksThen)
                 self._pulse.popleft() # and clear out the useless space, the mark starts us off.
             else:
-                readPulse = self._pulse.popleft()
-                if (len(self.pulses)): # we only append if we've already started (and we only start at a "start") or else it'll be chaos.
-                    self.pulses.append(readPulse[0] if readPulse[1] else -readPulse[0]) # write a + or - value to indicate mark or space.
+                readPulse = self._pulse.popleft() # already + for a mark, - for a space
+                if (decoder): # we only append if we've already started (and we only start at a "start") or else it'll be chaos.
+                    if (len(decoder) > 1): # not the header space
+                        if (readPulse > 0):
+                            if (readPulse < self.minMark):
+                                self.minMark = readPulse
+                            if (readPulse > self.maxMark):
+                                self.maxMark = readPulse
+                            space = self.lastSpace # only count a space once there's a mark after it
+                            if (space):
+                                if (space < self.minSpace):
+                                    self.minSpace = space
+                                if (space > self.maxSpace):
+                                    self.maxSpace = space
+                                self.lastSpace = 0
+                        else:
+                            self.lastSpace = -readPulse
+                    decoder.feed(readPulse)
 
     def buttonTimeout(self, ticksNow: int):
         # After we've serviced all the pulses, we need to see if the button has been released.
-        # I'm giving it 300ms, which should be adequate: if we haven't received a new signal within 300
-        # ms, the button wasn't being held.  Only matters if something is actively being held, though.
-        if (self.currentValue):
-            gap = ticks_diff(ticksNow, self.lastDecodeStartTicks)
-            if (gap > 300):
+        # If we haven't received a new signal within releaseAfter ms of the last one (a bit more than
+        # one repeat period, see learnPeriod), the button isn't being held any more.
+        # Only matters if something is actively being held, though.
+        if (self.currentValue is not None):
+            gap = ticks_diff(ticksNow, self.lastDecodeTicks)
+            if (gap > self.releaseAfter):
                 # Button released.
                 # send release message
-                self.events.append(("release", self.currentValue))
+                self.events.append("release", self.currentValue, ticksNow)
                 self.currentValue = None
 
     def service(self):
         # As frequently as possible, we call the service routing so the
         # class can go through and try to update everything internally
         ticksNow = ticks_ms()
+        if (self.trackSlack):
+            self.serviceGap = ticks_diff(ticksNow, self.lastServiceTicks)
+            self.lastServiceTicks = ticksNow
         self.readPulses(ticksNow) # Make sure we're keeping the queue for the pulseio module empty.
-        self.buttonTimeout(ticksNow) # Monitor timer to see if the button is still being pressed or has been released
+        owner = self.owner
+        owner.buttonTimeout(ticksNow) # Monitor timer to see if the button is still being pressed or has been released
 
-        newEvents = self.events
-        self.events = []
-        return newEvents
+        return owner.events # the caller pops what it wants from this
 
 
+# Sequences and chords are compiled into a tree of these: one per prefix, keyed by the next code.
+class sequenceNode:
+    def __init__(self):
+        self.next = {} # code -> sequenceNode
+        self.keys = None # what to press (one per layer, like the map) if the codes end here
+        self.timeout = 0 # ms to wait for the next code
+
 class IR_Handler(Module):
     def __init__(self):
         self.ir = None
         self.pin = None
+        # With more than one receiver (pointing different ways, say), set pins instead of pin.  They're
+        # serviced one per pass, and a frame that several of them catch only counts once.
+        self.pins = None
+        self.irs = []
+        self.nextIR = 0
         self.map = None
+        self.streaming = True # decode frames as they arrive rather than all at once at the end
+        self.protocols = () # set to PROTOCOLS (or your own list) to try fixed-timing decoders first
         self.newIRKey = send_string("New IR Code!")
+        self.layerMaps = None # compiled from map at boot: one {code: key} dict per layer
+        # If a frame comes in that isn't in the map but is within this many bits of exactly one
+        # code that is, treat it as that code rather than a new one.  0 turns it off.
+        self.fuzzyDistance = 0
+        self.knownCodes = None
+        self.fuzzyIndex = None
+        self.fuzzyLengths = None
+        self.newKeys = None # the "new" entry, if there is one
+        self.pressedKeys = {} # code: the key its press pressed, for the release to let go of
+        self.releasePercent = 150 # let go of a held button this % of the remote's repeat period after its last frame
+        self.releaseTimeout = 300 # ... or after this many ms, if that's sooner or we don't know the period
+        self.glitchUs = 150 # pulses shorter than this are noise, and get merged into the ones around them (0 = off)
+        self.maxPulseRatio = 6 # frames whose longest mark or space is more than this many times the shortest are noise (0 = off)
+        self.pulseBudget = 100 # pulses worked through per pass at most (0 = no limit); see ir.dropPolicy for what happens to the rest
+        self.dropPolicy = "full" # "full", "skip" or "oldest"
+        # Codes listed here (written the same way as in the map) don't hold their key down while the
+        # button is held: they tap it once, then again after typematicDelay ms, then faster and faster
+        # (each gap typematicAccel% of the last, down to typematicMinInterval) until the button's let go.
+        # Meant for volume/brightness/scrolling, where the host's own key repeat is too slow.
+        self.typematic = ()
+        self.typematicDelay = 250
+        self.typematicInterval = 60
+        self.typematicAccel = 70
+        self.typematicMinInterval = 10
+        self.typematicCodes = None
+        self.typematicKey = None # the key being repeated, if any
+        self.typematicNext = 0 # ms until its next tap
+        self.typematicTask = None
+        self.hidSends = 0 # main loop passes so far (counted in after_hid_send)
+        self.tapQueue = [] # (key, meta) for taps waiting to go out, the first one pressed
+        self.tapReleasePass = -1 # the pass tapKey's last release happened in
+        self.keyboard = None
+        # Learning mode.  Map entries named with an "@" ("@VOLUP": (KC.VOLU, ...)) get their code from
+        # learnFile rather than main.py.  Pressing learnIRKey goes through them in order, typing out
+        # each name, then waiting for that button to be pressed learnRepeats times.
+        self.learnFile = "/ircodes.bin"
+        self.learnRepeats = 3
+        self.learnDistance = 2 # bits the captures of one button can differ by and still count as the same
+        self.learnIRKey = make_key(on_press=self.learnPressed)
+        self.learnCodes = None # {"@name": code}, read from learnFile the first time it's needed
+        self.learnSlots = None # every "@" name in the map, sorted
+        self.learning = None # index into learnSlots while learning
+        self.learnCaptures = []
+        # Typing out new codes: the key for each hex digit is looked up once at boot, and the last
+        # newKeyCacheSize sequences built are kept, so a code that keeps coming in is just a lookup.
+        self.hexKeys = None
+        self.newKeyCacheSize = 16
+        self.newKeyCache = {} # code -> KeySequenceMeta
+        self.newKeyOrder = [] # codes in newKeyCache, least recently used first
+        # Latency, for tuning: with measureLatency on, how long each frame takes to decode, how long
+        # from the end of a frame to us seeing its press, and from then to the HID report going out
+        # are kept in histograms.  Press latencyKey (or call latencyReport()) to print them to serial.
+        self.measureLatency = False
+        self.decodeTimes = None
+        self.queueTimes = None
+        self.sendTimes = None
+        self.sendStamp = None # end of the frame whose (plain add_key) press is waiting for the next HID report
+        self.latencyKey = make_key(on_press=self.printLatency)
+        # Multi-code commands, written like the map but keyed by a tuple of codes:
+        #   sequences = {("F708", "B47", "80B47"): (KC.A, ...)} - MENU, then 1, then 2
+        #   chords = {("490", "C90"): (KC.B, ...)} - both, in either order
+        # Each code has to come within sequenceTimeout (chordTimeout) ms of the one before.  The
+        # first code of a sequence doesn't do its own thing straight away: if the sequence doesn't
+        # get finished, the codes so far are tapped as normal.
+        self.sequences = {}
+        self.chords = {}
+        self.sequenceTimeout = 1000
+        self.chordTimeout = 300
+        self.sequenceRoot = None # compiled from sequences and chords, None if there aren't any
+        self.sequenceAt = None # the node we've got to
+        self.sequenceCodes = [] # the codes that got us there
+        self.swallowedCode = None # a code that went to a sequence: its release is ours too
+        self.sequenceTask = None
+        self.sequencePending = False
+        # Hold-tap: a KC.HT(tap, hold) (or KC.LT) in the map taps `tap` for a short press, and holds
+        # `hold` if the button's still going after tap_time (the HoldTap module's, unless the key says).
+        # "Still going" means the remote's still repeating: a frame within the last repeat period.
+        self.holdTapKey = None # the HT key for the button that's down, if it's one
+        self.holdTapHeld = False # whether it's turned into a hold
+        self.holdTapTimeout = None
+        self.holdTapStart = 0 # when the frame that pressed it started
 
     def on_runtime_enable(self, keyboard):
         return
@@ -252,47 +1346,646 @@ class IR_Handler(Module):
         return
 
     def during_bootup(self, keyboard):
-        if self.pin:
-            self.ir = ir(self.pin)
+        self.keyboard = keyboard
+        self.hexKeys = []
+        for char in "0123456789ABCDEF":
+            kc = getattr(KC, char)
+            if char.isupper():
+                kc = KC.LSHIFT(kc)
+            self.hexKeys.append(kc)
+        self.compileMap()
+        pins = self.pins or ((self.pin,) if self.pin else ())
+        self.irs = []
+        if (self.measureLatency):
+            self.decodeTimes = histogram("decode", "us", 14)
+            self.queueTimes = histogram("frame end to press", "ms")
+            self.sendTimes = histogram("frame end to HID", "ms")
+        for pin in pins:
+            receiver = ir(pin, streaming=self.streaming, protocols=self.protocols, glitchUs=self.glitchUs)
+            receiver.maxPulseRatio = self.maxPulseRatio
+            receiver.pulseBudget = self.pulseBudget
+            receiver.dropPolicy = self.dropPolicy
+            receiver.releasePercent = self.releasePercent
+            receiver.releaseTimeout = self.releaseTimeout
+            receiver.releaseAfter = self.releaseTimeout
+            if (self.fuzzyDistance > 0):
+                receiver.resolveCode = self.nearestCode
+            receiver.decodeTimes = self.decodeTimes
+            if (self.irs):
+                receiver.owner = self.irs[0]
+            receiver.trackSlack = len(pins) > 1
+            self.irs.append(receiver)
+        if (self.irs):
+            self.ir = self.irs[0]
+
+    def compileMap(self):
+        # The map is written with hex strings (the way codes get typed out), but the decoder
+        # hands us ints: convert once here so each IR event is a single dict lookup.
+        # If you change self.map after boot, call this again.
+        self.layerMaps = []
+        self.newKeys = None
+        self.typematicCodes = {}
+        self.learnSlots = []
+        if (not self.map):
+            return
+        for code in self.typematic:
+            code = self.mapCode(code)
+            if (code is not None):
+                self.typematicCodes[code] = True
+        for name, keys in self.map.items():
+            if (name == "new"):
+                self.newKeys = keys
+                continue
+            if (isinstance(name, str)) and (name.startswith("@")):
+                self.learnSlots.append(name)
+            code = self.mapCode(name)
+            if (code is None): # not learned yet
+                continue
+            for layer, key in enumerate(keys):
+                while (len(self.layerMaps) <= layer):
+                    self.layerMaps.append({})
+                self.layerMaps[layer][code] = key
+        self.learnSlots.sort()
+        self.compileSequences()
+        if (self.fuzzyDistance > 0):
+            self.compileFuzzyIndex()
+
+    def compileSequences(self):
+        self.sequenceRoot = None
+        self.sequenceAt = None
+        self.sequenceCodes = []
+        if (not self.sequences) and (not self.chords):
+            return
+        self.sequenceRoot = sequenceNode()
+        for codes, keys in self.sequences.items():
+            self.addSequence(codes, keys, self.sequenceTimeout)
+        for codes, keys in self.chords.items():
+            for order in permutations(list(codes)):
+                self.addSequence(order, keys, self.chordTimeout)
+        self.sequenceAt = self.sequenceRoot
+
+    def addSequence(self, codes, keys, timeout: int):
+        node = self.sequenceRoot
+        for code in codes:
+            code = self.mapCode(code)
+            if (code is None): # a learned code that isn't yet
+                return
+            nextNode = node.next.get(code)
+            if (nextNode is None):
+                nextNode = node.next[code] = sequenceNode()
+            if (timeout > node.timeout):
+                node.timeout = timeout
+            node = nextNode
+        node.keys = keys
+
+    def mapCode(self, code):
+        # A code as written in the map (hex string, int, or learned "@name") -> int, or None
+        if (not isinstance(code, str)):
+            return code
+        if (code.startswith("@")):
+            return self.loadCodes().get(code)
+        return int(code, 16)
+
+    # For nearest-code matching, codes are bucketed by bit length and each one is cut into
+    # fuzzyDistance+1 chunks.  Anything within fuzzyDistance bits of a code has to match it exactly
+    # on at least one chunk, so a lookup is a fixed number of dict hits (one per chunk, for each
+    # bit length in the map - usually only a few) plus a bit count on whatever they turn up, no
+    # matter how many codes are mapped.
+    def _chunking(self, bitLength: int):
+        size = (bitLength + self.fuzzyDistance) // (self.fuzzyDistance + 1)
+        return size, (1 << size) - 1
+
+    def compileFuzzyIndex(self):
+        self.knownCodes = {}
+        self.fuzzyIndex = {}
+        self.fuzzyLengths = []
+        for layerMap in self.layerMaps:
+            for code in layerMap:
+                self.knownCodes[code] = True
+        # Codes that only appear in sequences and chords are known too, or they'd be snapped to a
+        # near one in the map and the sequence could never be entered.
+        nodes = [self.sequenceRoot] if (self.sequenceRoot is not None) else []
+        while (nodes):
+            for code, node in nodes.pop().next.items():
+                self.knownCodes[code] = True
+                nodes.append(node)
+        for code in self.knownCodes:
+            bitLength = len(bin(code)) - 2
+            if (bitLength not in self.fuzzyLengths):
+                self.fuzzyLengths.append(bitLength)
+            size, mask = self._chunking(bitLength)
+            for i in range(self.fuzzyDistance + 1):
+                key = (((code >> (i * size)) & mask) << 16) | (i << 10) | bitLength
+                bucket = self.fuzzyIndex.get(key)
+                if (bucket is None):
+                    self.fuzzyIndex[key] = [code]
+                else:
+                    bucket.append(code)
+
+    def nearestCode(self, code: int):
+        # The known code closest to this one, if there's exactly one within fuzzyDistance bits;
+        # otherwise the code as it is.
+        if (code in self.knownCodes):
+            return code
+        distance = self.fuzzyDistance
+        best = code
+        bestDistance = distance + 1
+        tied = False
+        # Every length, not just ones near this code's: a flipped top bit can change the length a lot.
+        for length in self.fuzzyLengths:
+            size, mask = self._chunking(length)
+            for i in range(distance + 1):
+                bucket = self.fuzzyIndex.get((((code >> (i * size)) & mask) << 16) | (i << 10) | length)
+                if (bucket is None):
+                    continue
+                for candidate in bucket:
+                    if (candidate == best):
+                        continue
+                    d = hamming(code, candidate, bestDistance + 1)
+                    if (d < bestDistance):
+                        best = candidate
+                        bestDistance = d
+                        tied = False
+                    elif (d == bestDistance):
+                        tied = True
+        return code if tied else best
+
+    # The code database is a 5-byte header, then one record per learned button:
+    #   name length (1 byte), name (ascii, with the "@"), code length (1 byte), code (little-endian)
+    # Re-learning a button just appends another record; the last one wins.  It's read once, the first
+    # time it's needed, so boot doesn't pay for it unless the map uses learned codes.
+    def loadCodes(self):
+        if (self.learnCodes is None):
+            self.learnCodes = {}
+            try:
+                with open(self.learnFile, "rb") as fp:
+                    data = fp.read()
+            except OSError:
+                data = b""
+            if (data[:5] == b"IRDB\x01"):
+                i = 5
+                while (i < len(data)):
+                    nameLength = data[i]
+                    name = str(data[i + 1:i + 1 + nameLength], "ascii")
+                    i += 1 + nameLength
+                    codeLength = data[i]
+                    self.learnCodes[name] = int.from_bytes(data[i + 1:i + 1 + codeLength], "little")
+                    i += 1 + codeLength
+        return self.learnCodes
+
+    def saveCode(self, name: str, code: int):
+        self.loadCodes()[name] = code
+        codeBytes = code.to_bytes((len(bin(code)) + 5) // 8, "little")
+        record = bytes((len(name),)) + name.encode("ascii") + bytes((len(codeBytes),)) + codeBytes
+        try:
+            with open(self.learnFile, "ab") as fp:
+                if (fp.tell() == 0):
+                    fp.write(b"IRDB\x01")
+                fp.write(record)
+        except OSError: # CIRCUITPY is writable by the computer, not us: keep it until the next reboot
+            return False
+        return True
+
+    def typeText(self, text: str):
+        self.keyboard.tap_key(send_string(text))
+
+    def learnPressed(self, key, keyboard, *args):
+        if (self.learning is not None): # pressed again: stop
+            self.learning = None
+            self.typeText(" stopped")
+            return
+        self.compileMap()
+        if (not self.learnSlots):
+            self.typeText("Nothing to learn")
+            return
+        self.learning = 0
+        self.learnCaptures = []
+        self.typeText(self.learnSlots[0] + ": ")
+
+    def learnCode(self, code: int):
+        # One press of the button being learned.  Once we have enough, pick the code most of them
+        # agree on, save it and move on to the next name.
+        self.learnCaptures.append(code)
+        if (len(self.learnCaptures) < self.learnRepeats):
+            return
+        code = self.canonicalCode(self.learnCaptures)
+        self.learnCaptures = []
+        if (code is None):
+            self.typeText("? ")
+            return
+        name = self.learnSlots[self.learning]
+        saved = self.saveCode(name, code)
+        self.compileMap()
+        text = ("%X" % code) + ("" if saved else " (not saved)") + " "
+        self.learning += 1
+        if (self.learning >= len(self.learnSlots)): # (we stop learning once this button's let go)
+            self.typeText(text + "done")
+        else:
+            self.typeText(text + self.learnSlots[self.learning] + ": ")
+
+    def canonicalCode(self, captures):
+        # Find the capture the most others are within learnDistance bits of.  If that's a majority,
+        # take a bitwise vote between them; otherwise the captures don't agree and we start over.
+        # This clusters decoded codes, not pulse timings: the decoder has already grouped each
+        # frame's timings, and a code voted from the codes it gives is one it'll give again.
+        best = None
+        bestGroup = ()
+        for code in captures:
+            group = [other for other in captures if hamming(code, other, self.learnDistance + 1) <= self.learnDistance]
+            if (len(group) > len(bestGroup)):
+                best = code
+                bestGroup = group
+        if (len(bestGroup) * 2 <= len(captures)):
+            return None
+        code = 0
+        bit = 1
+        top = max(bestGroup)
+        while (bit <= top):
+            votes = 0
+            for other in bestGroup:
+                if (other & bit):
+                    votes += 1
+            if (votes * 2 > len(bestGroup)):
+                code |= bit
+            bit <<= 1
+        return code
 
     def before_matrix_scan(self, keyboard):
         '''
         Return value will be injected as an extra matrix update
         '''
         if (self.ir is not None):
-            events = self.ir.service()
-            for event in events:
-                ev, key = event
-                which = None
-                mapKeys = self.map.keys()
-                if (key in mapKeys):
-                    which = self.map[key]
-                elif ("new" in mapKeys) and (key != "repeat"):
-                    which = self.map["new"]
-                if (which):
-                    if (isinstance(key, str)):
-                        seq = []
-                        for char in key:
-                            kc = getattr(KC, char.upper())
-                            if char.isupper():
-                                kc = KC.LSHIFT(kc)
-                            seq.append(kc)
-                        self.newIRKey.meta = KeySequenceMeta(seq)
+            if (len(self.irs) > 1):
+                receiver = self.irs[self.nextIR]
+                self.nextIR += 1
+                if (self.nextIR == len(self.irs)):
+                    self.nextIR = 0
+            else:
+                receiver = self.ir
+            events = receiver.service()
+            while (events):
+                code = events.popleft()
+                ev = events.kind
+                if (self.queueTimes is not None) and (ev == "press"):
+                    self.queueTimes.add(ticks_diff(ticks_ms(), events.ticks))
+                if (self.learning is None) and (self.sequenceRoot is not None) and (self.matchSequence(keyboard, ev, code)):
+                    continue
+                if (self.learning is not None):
+                    if (self.learning < len(self.learnSlots)):
+                        if (ev == "press"):
+                            self.learnCode(code)
+                    elif (ev == "release"): # the last button learned, let go
+                        self.learning = None
+                    continue
+                if (ev == "release"):
+                    # Whatever the press pressed - looking it up again would find another key if
+                    # the press changed layers (KC.LT, KC.MO), and that layer would never go away.
+                    key = self.pressedKeys.pop(code, None)
+                else:
                     layer_id = keyboard.active_layers[0]
-                    if (ev == "release"):
-                        keyboard.remove_key(which[layer_id])
+                    key = None
+                    if (layer_id < len(self.layerMaps)):
+                        key = self.layerMaps[layer_id].get(code)
+                    if (key is None) and (self.newKeys):
+                        key = self.newKeys[layer_id]
+                    if (key is self.newIRKey): # mapped or not, it types the code that got us here
+                        self.newIRKey.meta = self.newCodeMeta(code)
+                    if (key):
+                        self.pressedKeys[code] = key
+                if (key):
+                    if (isinstance(key.meta, HoldTapKeyMeta)):
+                        if (ev == "release"):
+                            self.holdTapReleased(keyboard)
+                        else:
+                            self.holdTapPressed(keyboard, key)
+                    elif (code in self.typematicCodes):
+                        if (ev == "release"):
+                            self.stopTypematic()
+                        else:
+                            self.startTypematic(key)
+                    elif (ev == "release"):
+                        keyboard.remove_key(key)
                     else:
-                        keyboard.add_key(which[layer_id])
+                        keyboard.add_key(key)
+                        # Only presses that go out this cycle are timed to the HID report (hold-taps,
+                        # sequences and typematic keys send theirs later, or not at all).
+                        if (self.sendTimes is not None):
+                            self.sendStamp = events.ticks
 
         return keyboard
 
-    def after_matrix_scan(self, keyboard):
+    def matchSequence(self, keyboard, ev: str, code: int):
+        # One step through the sequence tree: a dict lookup whatever's defined.  Returns True if
+        # the event was used up by a sequence.
+        if (ev == "release"):
+            if (code == self.swallowedCode):
+                self.swallowedCode = None
+                return True
+            return False
+        node = self.sequenceAt.next.get(code)
+        if (node is None):
+            if (self.sequenceAt is self.sequenceRoot):
+                return False
+            self.abandonSequence(keyboard) # this one doesn't fit: give back what we had, and start again from it
+            node = self.sequenceRoot.next.get(code)
+            if (node is None):
+                return False
+        if (self.sequencePending):
+            cancel_task(self.sequenceTask)
+            self.sequencePending = False
+        self.sequenceCodes.append(code)
+        self.swallowedCode = code
+        if (node.next):
+            self.sequenceAt = node
+            if (self.sequenceTask is None):
+                self.sequenceTask = create_task(self.sequenceTimedOut, after_ms=node.timeout)
+            else:
+                create_task(self.sequenceTask, after_ms=node.timeout)
+            self.sequencePending = True
+        else:
+            self.finishSequence(keyboard, node)
+        return True
+
+    def sequenceTimedOut(self):
+        self.sequencePending = False
+        node = self.sequenceAt
+        if (node.keys is not None): # a shorter sequence that's also the start of a longer one
+            self.finishSequence(self.keyboard, node)
+        else:
+            self.abandonSequence(self.keyboard)
+
+    def finishSequence(self, keyboard, node):
+        layer_id = keyboard.active_layers[0]
+        if (layer_id < len(node.keys)):
+            self.tapKey(node.keys[layer_id])
+        self.sequenceAt = self.sequenceRoot
+        self.sequenceCodes = []
+
+    def abandonSequence(self, keyboard):
+        if (self.sequencePending):
+            cancel_task(self.sequenceTask)
+            self.sequencePending = False
+        layer_id = keyboard.active_layers[0]
+        if (layer_id < len(self.layerMaps)):
+            for code in self.sequenceCodes:
+                key = self.layerMaps[layer_id].get(code)
+                if (key):
+                    self.tapKey(key, self.newCodeMeta(code) if (key is self.newIRKey) else None)
+        self.sequenceAt = self.sequenceRoot
+        self.sequenceCodes = []
+
+    def holdTapPressed(self, keyboard, key):
+        self.holdTapReleased(keyboard) # a new button means the last one's gone
+        self.holdTapKey = key
+        self.holdTapHeld = False
+        self.holdTapStart = self.ir.lastDecodeStartTicks
+        tapTime = key.meta.tap_time
+        if (tapTime is None): # the installed HoldTap (or Layers) decides, as it would on the matrix
+            tapTime = HoldTap.tap_time
+            for module in keyboard.modules:
+                if (isinstance(module, HoldTap)):
+                    tapTime = module.tap_time
+                    break
+        self.holdTapTimeout = keyboard.set_timeout(tapTime, self.holdTapExpired)
+
+    def holdTapExpired(self):
+        self.holdTapTimeout = None
+        key = self.holdTapKey
+        if (key is None):
+            return
+        # Held means the remote's repeated since the press (a lone frame can still be inside the
+        # window when tap_time is short), and recently enough that it's still going.
+        if (ticks_diff(self.ir.lastDecodeStartTicks, self.holdTapStart) > 0) and (self.stillRepeating()):
+            self.holdTapHeld = True
+            self.keyboard.add_key(key.meta.hold)
+        else: # it stopped repeating: a tap, even if the release hasn't been noticed yet
+            self.holdTapKey = None
+            self.tapKey(key.meta.tap)
+
+    def holdTapReleased(self, keyboard):
+        key = self.holdTapKey
+        if (key is None):
+            return
+        self.holdTapKey = None
+        if (self.holdTapHeld):
+            keyboard.remove_key(key.meta.hold)
+        else:
+            keyboard.cancel_timeout(self.holdTapTimeout)
+            self.holdTapTimeout = None
+            keyboard.tap_key(key.meta.tap)
+
+    def newCodeMeta(self, code: int):
+        # The key sequence that types out this code, built once and kept while it's recently used
+        meta = self.newKeyCache.get(code)
+        if (meta is not None):
+            self.newKeyOrder.remove(code)
+            self.newKeyOrder.append(code)
+            return meta
+        hexKeys = self.hexKeys
+        meta = KeySequenceMeta([hexKeys[int(char, 16)] for char in "%X" % code])
+        if (len(self.newKeyOrder) >= self.newKeyCacheSize):
+            del self.newKeyCache[self.newKeyOrder.pop(0)]
+        self.newKeyCache[code] = meta
+        self.newKeyOrder.append(code)
+        return meta
+
+    def stillRepeating(self):
+        # Whether the remote's sent a frame within about a repeat period - the release itself can
+        # take one and a half, so a button that's been let go looks held for a while otherwise.
+        receiver = self.ir # the one keeping track of what's held
+        window = receiver.repeatPeriod * 5 // 4 if (receiver.repeatPeriod) else receiver.releaseAfter
+        return (receiver.currentValue is not None) and (ticks_diff(ticks_ms(), receiver.lastDecodeTicks) <= window)
+
+    def tapKey(self, key, meta=None):
+        # keyboard.tap_key() releases on the next scheduler pass - but from inside a scheduler task
+        # that's the pass we're in, so the key would be gone before the report goes out.  Release it
+        # a millisecond later instead, which is always a pass of its own, and queue taps that come
+        # while one's going so that several in a row (a sequence given back) each get a report.
+        # meta, if given, is set on the key just before it's pressed (for newIRKey).
+        self.tapQueue.append((key, meta))
+        if (len(self.tapQueue) == 1):
+            self.tapPress()
+
+    def tapPress(self):
+        key, meta = self.tapQueue[0]
+        if (meta is not None):
+            key.meta = meta
+        self.keyboard.add_key(key)
+        self.keyboard.set_timeout(1, self.tapReleased)
+
+    def tapReleased(self):
+        key, _ = self.tapQueue.pop(0)
+        self.keyboard.remove_key(key)
+        self.tapReleasePass = self.hidSends
+        if (self.tapQueue):
+            self.keyboard.set_timeout(1, self.tapPress)
+
+    def startTypematic(self, key):
+        self.stopTypematic()
+        self.tapKey(key)
+        self.typematicKey = key
+        self.typematicNext = self.typematicInterval
+        if (self.typematicTask is None):
+            self.typematicTask = create_task(self.typematicTap, after_ms=self.typematicDelay)
+        else:
+            create_task(self.typematicTask, after_ms=self.typematicDelay)
+
+    def typematicTap(self):
+        # Runs from the scheduler while a typematic button is held; queues itself up again.
+        key = self.typematicKey
+        if (key is None):
+            return
+        if (not self.stillRepeating()): # let go; the release will catch up
+            self.typematicKey = None
+            return
+        if (self.tapReleasePass == self.hidSends):
+            # The last tap's release is in this pass too (the loop's slower than typematicMinInterval),
+            # and pressing again now would mean the report never shows it let go.
+            create_task(self.typematicTask, after_ms=1)
+            return
+        self.tapKey(key)
+        create_task(self.typematicTask, after_ms=self.typematicNext)
+        self.typematicNext = max(self.typematicNext * self.typematicAccel // 100, self.typematicMinInterval)
+
+    def stopTypematic(self):
+        if (self.typematicKey is not None):
+            self.typematicKey = None
+            cancel_task(self.typematicTask)
+
+    def after_hid_send(self, keyboard):
+        self.hidSends += 1
+        if (self.sendStamp is not None):
+            self.sendTimes.add(ticks_diff(ticks_ms(), self.sendStamp))
+            self.sendStamp = None
+
+    def on_powersave_enable(self, keyboard):
         return
 
-    def before_hid_send(self, keyboard):
+    def on_powersave_disable(self, keyboard):
         return
 
-    def after_hid_send(self, keyboard):
+    def latencyReport(self):
+        if (self.decodeTimes is None):
+            return "IR latency: set irHandler.measureLatency = True"
+        lines = [self.decodeTimes.report(), self.queueTimes.report(), self.sendTimes.report()]
+        for i, receiver in enumerate(self.irs):
+            lines.append("receiver %d: backlog %d, pulse overflow %d, event overflow %d, glitches %d, rejected %d, dropped %d" % (
+                i, receiver.backlogHits, receiver._pulse.overflow, receiver.events.overflow, receiver._pulse.merged, receiver.rejectedFrames, receiver.droppedFrames,
+            ))
+        return "\n".join(lines)
+
+    def printLatency(self, key, keyboard, *args):
+        print(self.latencyReport())
+
+
+# Sending.  KC.IR_SEND(code, protocol="NEC") (or any of the PROTOCOLS by name, with bits=15/20 for
+# the longer Sony codes), or KC.IR_SEND(pulses=(9000, 4500, 560, ...)) for a raw frame.  The frames
+# are worked out once, when the key is made, as the array('H') PulseOut wants: both toggle states
+# for RC5/RC6, plus the repeat frame if the protocol has one.
+class IRSendMeta:
+    def __init__(self, code=None, protocol=None, pulses=None, bits: int = 0):
+        self.repeat = None
+        self.period = 0
+        self.minFrames = 1
+        if (pulses is not None):
+            frame = array('H', pulses)
+            self.frames = (frame, frame)
+        else:
+            if (isinstance(protocol, str)):
+                for candidate in PROTOCOLS:
+                    if (candidate.name == protocol):
+                        protocol = candidate
+                        break
+            if (not isinstance(protocol, IRProtocol)):
+                raise ValueError("IR_SEND needs a protocol (one of PROTOCOLS, or its name) or pulses")
+            if (isinstance(code, str)):
+                code = int(code, 16)
+            frame = protocol.encode(code, 0, bits)
+            if (frame is None):
+                raise ValueError("Can't send " + str(protocol.name))
+            self.frames = (array('H', frame), array('H', protocol.encode(code, 1, bits)))
+            repeat = protocol.repeatFrame()
+            if (repeat is not None):
+                self.repeat = array('H', repeat)
+            self.period = protocol.repeatPeriod
+            self.minFrames = protocol.minFrames
+        # How long each takes to send, so the next one can start a period after this one did.
+        self.frameMs = (sum(self.frames[0]) + 999) // 1000
+        self.repeatMs = self.frameMs if (self.repeat is None) else (sum(self.repeat) + 999) // 1000
+
+
+class IR_Transmitter(Module):
+    def __init__(self):
+        self.pin = None
+        self.frequency = 38000
+        self.dutyCycle = 1 << 15 # out of 65535, so half the time
+        self.pulseOut = None
+        # PulseOut.send() doesn't return until the frame's gone, so we send one frame at a time:
+        # the gaps between them (and the repeats while the key's held) are scheduler tasks, and
+        # the keyboard carries on in between.
+        self.sending = None # the IRSendMeta going out
+        self.held = False
+        self.sent = 0 # frames sent for this press
+        self.toggle = 0 # flips every press, for the protocols that have a toggle bit
+        self.task = None
+        self.pending = False # whether task is waiting to run
+        make_argumented_key(
+            validator=IRSendMeta,
+            names=('IR_SEND',),
+            on_press=self.sendPressed,
+            on_release=self.sendReleased,
+        )
+
+    def during_bootup(self, keyboard):
+        if self.pin:
+            self.pulseOut = pulseio.PulseOut(self.pin, frequency=self.frequency, duty_cycle=self.dutyCycle)
+
+    def sendPressed(self, key, keyboard, *args, **kwargs):
+        if (self.pulseOut is None):
+            return
+        if (self.pending):
+            cancel_task(self.task)
+            self.pending = False
+        self.toggle ^= 1
+        self.sending = key.meta
+        self.held = True
+        self.sent = 0
+        self.sendFrame()
+
+    def sendReleased(self, key, keyboard, *args, **kwargs):
+        if (key.meta is self.sending):
+            self.held = False
+            if (self.pending) and (self.sent >= self.sending.minFrames):
+                cancel_task(self.task)
+                self.pending = False
+                self.sending = None
+
+    def sendFrame(self):
+        self.pending = False
+        meta = self.sending
+        if (meta is None):
+            return
+        if (self.sent) and (meta.repeat is not None):
+            frame = meta.repeat
+            after = meta.period - meta.repeatMs
+        else:
+            frame = meta.frames[self.toggle]
+            after = meta.period - meta.frameMs
+        self.pulseOut.send(frame)
+        self.sent += 1
+        if (meta.period) and ((self.held) or (self.sent < meta.minFrames)):
+            if (self.task is None):
+                self.task = create_task(self.sendFrame, after_ms=max(after, 1))
+            else:
+                create_task(self.task, after_ms=max(after, 1))
+            self.pending = True
+        else:
+            self.sending = None
+
+    def on_runtime_enable(self, keyboard):
+        return
+
+    def on_runtime_disable(self, keyboard):
         return
 
     def on_powersave_enable(self, keyboard):
@@ -8,5 +8,6 @@ button.pull = digitalio.Pull.UP
 
 if (button.value):
     storage.disable_usb_drive()
+    storage.remount("/", readonly=False) # the computer can't write to it now, so we can (IR learning mode saves codes)
 else:
     storage.enable_usb_drive()
@@ -15,7 +15,9 @@ class Extension:
 
         self.on_runtime_disable(keyboard)
 
-    # The below methods should be implemented by subclasses
+    # The below methods should be implemented by subclasses. before_matrix_scan,
+    # after_matrix_scan, before_hid_send and after_hid_send are optional: the
+    # keyboard only calls them on extensions that override them.
 
     def on_runtime_enable(self, keyboard):
         raise NotImplementedError
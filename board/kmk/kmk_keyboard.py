@@ -3,15 +3,27 @@ try:
 except ImportError:
     pass
 
+from array import array
 from collections import namedtuple
 from keypad import Event as KeyEvent
+from supervisor import ticks_ms
+
+from time import sleep
 
 from kmk.consts import UnicodeMode
 from kmk.hid import BLEHID, USBHID, AbstractHID, HIDModes
 from kmk.keys import KC, Key
+from kmk.extensions import Extension
 from kmk.modules import Module
 from kmk.scanners.keypad import MatrixScanner
-from kmk.scheduler import Task, cancel_task, create_task, get_due_task
+from kmk.kmktime import ticks_diff
+from kmk.scheduler import (
+    Task,
+    cancel_task,
+    create_task,
+    get_due_task,
+    get_next_deadline,
+)
 from kmk.utils import Debug
 
 debug = Debug('kmk.keyboard')
@@ -51,6 +63,20 @@ class KMKKeyboard:
     extensions = []
     sandbox = Sandbox()
 
+    # Handle every pending matrix event in one cycle instead of one per cycle.
+    batch_matrix_events = False
+
+    # How many layer combinations to keep resolved keymaps for.
+    keymap_cache_size = 8
+
+    # Sleep between cycles while there's nothing to do, until the next
+    # scheduled task is due or a key changes, checking every idle_poll_ms and
+    # for at most idle_max_ms at a time. Modules that poll every cycle (IR,
+    # Split) get called less often while idle.
+    idle_sleep = False
+    idle_max_ms = 10
+    idle_poll_ms = 1
+
     #####
     # Internal State
     keys_pressed = set()
@@ -68,8 +94,18 @@ class KMKKeyboard:
     _trigger_powersave_disable = False
     _go_args = None
     _processing_timeouts = False
+    _coord_index = None
+    _coord_index_for = None
+    _resolved_keys = None
+    idle_ms = 0
+    idle_count = 0
+    _keymap_cache = {}
+    _keymap_cache_order = []
     _resume_buffer = []
     _resume_buffer_x = []
+    # Per main loop hook: the modules and extensions that implement it.
+    _module_hooks = {}
+    _extension_hooks = {}
 
     # this should almost always be PREpended to, replaces
     # former use of reversed_active_layers which had pointless
@@ -106,27 +142,123 @@ class KMKKeyboard:
         if kevent is not None:
             self._on_matrix_changed(kevent)
 
+    def _scan_matrix(self) -> Optional[KeyEvent]:
+        for matrix in self.matrix:
+            update = matrix.scan_for_changes()
+            if update:
+                return update
+
+    def _drain_matrix(self) -> None:
+        '''
+        Queue up everything else the scanners have waiting. Each event gets an
+        `after_matrix_scan` of its own (Split forwards them from there), just
+        like the first one did.
+        '''
+        self.sandbox.secondary_matrix_update = None
+        while True:
+            update = self._scan_matrix()
+            if not update:
+                break
+            self.matrix_update = update
+            self.sandbox.matrix_update = update
+            self.after_matrix_scan()
+            if self.matrix_update:
+                self.matrix_update_queue.append(self.matrix_update)
+            self.matrix_update = None
+
+    def _handle_matrix_queue(self) -> None:
+        '''
+        Handle all queued matrix events, in order. Anything an event leaves
+        behind (buffered key events, a pending HID report) is dealt with before
+        the next one, the same as if it had had a cycle to itself: each report
+        sent in between gets its own before_hid_send / after_hid_send pair.
+        '''
+        queue = self.matrix_update_queue
+        while queue:
+            self._handle_matrix_report(queue.pop(0))
+            if not queue:
+                break
+            if self._resume_buffer:
+                self._process_resume_buffer()
+            if self.hid_pending:
+                self.before_hid_send()
+                if self.hid_pending:
+                    self._send_hid()
+                self.after_hid_send()
+
     def _find_key_in_map(self, int_coord: int) -> Key:
+        if self._coord_index_for is not self.coord_mapping:
+            self._init_coord_index()
+
         try:
-            idx = self.coord_mapping.index(int_coord)
-        except ValueError:
+            idx = self._coord_index[int_coord]
+        except IndexError:
+            idx = -1
+
+        if idx < 0:
             if debug.enabled:
                 debug('no such int_coord: ', int_coord)
 
             return None
 
-        for layer in self.active_layers:
-            try:
-                key = self.keymap[layer][idx]
-            except IndexError:
-                key = None
-                if debug.enabled:
-                    debug('keymap IndexError: idx=', idx, ' layer=', layer)
+        keys = self._resolved_keys
+        if keys is None:
+            keys = self._resolve_active_layers()
 
-            if not key or key == KC.TRNS:
-                continue
+        return keys[idx]
+
+    def _resolve_active_layers(self) -> list:
+        '''
+        The key each keymap position resolves to with the current layer stack,
+        transparent keys already looked through. The last `keymap_cache_size`
+        stacks are kept, least recently used dropped first.
+        '''
+        layers = tuple(self.active_layers)
+        cache = self._keymap_cache
+        order = self._keymap_cache_order
+
+        keys = cache.get(layers)
+        if keys is None:
+            keys = [None] * len(self.coord_mapping)
+            for idx in range(len(keys)):
+                for layer in layers:
+                    try:
+                        key = self.keymap[layer][idx]
+                    except IndexError:
+                        key = None
+                        if debug.enabled:
+                            debug('keymap IndexError: idx=', idx, ' layer=', layer)
+
+                    if not key or key == KC.TRNS:
+                        continue
+
+                    keys[idx] = key
+                    break
+
+            cache[layers] = keys
+            if len(order) >= self.keymap_cache_size:
+                del cache[order.pop(0)]
+        else:
+            order.remove(layers)
+        order.append(layers)
+
+        self._resolved_keys = keys
+        return keys
+
+    def active_layers_changed(self) -> None:
+        '''
+        Call after changing `active_layers`, so keys are looked up on the new
+        layer stack. Layers does this for you.
+        '''
+        self._resolved_keys = None
 
-            return key
+    def keymap_changed(self) -> None:
+        '''
+        Call after changing `keymap` (or `coord_mapping`) at runtime.
+        '''
+        self._resolved_keys = None
+        self._keymap_cache.clear()
+        self._keymap_cache_order.clear()
 
     def _on_matrix_changed(self, kevent: KeyEvent) -> None:
         int_coord = kevent.key_number
@@ -271,6 +403,39 @@ class KMKKeyboard:
     def cancel_timeout(self, timeout_key: int) -> None:
         cancel_task(timeout_key)
 
+    def _idle(self) -> None:
+        '''
+        Sleep until there's something to do: a scheduled task coming due or a
+        scanner event, at most `idle_max_ms`. Time spent here is added up in
+        `idle_ms` (and the number of naps in `idle_count`).
+        '''
+        if (
+            self.matrix_update_queue
+            or self._resume_buffer
+            or self.hid_pending
+            or self._trigger_powersave_enable
+            or self._trigger_powersave_disable
+        ):
+            return
+
+        due = get_next_deadline()
+        nap = self.idle_max_ms if due is None else min(due, self.idle_max_ms)
+        if nap <= 0:
+            return
+
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < nap and not self._events_pending():
+            sleep(self.idle_poll_ms / 1000)
+
+        self.idle_ms += ticks_diff(ticks_ms(), start)
+        self.idle_count += 1
+
+    def _events_pending(self) -> bool:
+        for matrix in self.matrix:
+            if matrix.events_pending():
+                return True
+        return False
+
     def _process_timeouts(self) -> None:
         for task in get_due_task():
             task()
@@ -308,6 +473,21 @@ class KMKKeyboard:
                 cm.extend(m.coord_mapping)
             self.coord_mapping = tuple(cm)
 
+    def _init_coord_index(self) -> None:
+        '''
+        Build the reverse of `coord_mapping`: for each int_coord, its position
+        in `coord_mapping` (what `coord_mapping.index()` would return), or -1.
+        `_find_key_in_map` rebuilds it whenever `coord_mapping` is replaced,
+        e.g. by Split during bootup.
+        '''
+        cm = self.coord_mapping or ()
+        index = array('h', [-1] * (max(cm) + 1 if cm else 0))
+        for idx in range(len(cm) - 1, -1, -1):
+            index[cm[idx]] = idx
+        self._coord_index = index
+        self._coord_index_for = self.coord_mapping
+        self.keymap_changed()
+
     def _init_hid(self) -> None:
         if self.hid_type == HIDModes.NOOP:
             self._hid_helper = AbstractHID
@@ -371,58 +551,94 @@ class KMKKeyboard:
                 debug_error(ext, 'during_bootup', err)
                 self.extensions[idx] = None
 
-        self.modules[:] = [_ for _ in self.modules if _]
+        self.extensions[:] = [_ for _ in self.extensions if _]
 
         if debug.enabled:
             debug('extensions=', [_.__class__.__name__ for _ in self.extensions])
 
+        self._init_hooks()
+
+    def _init_hooks(self) -> None:
+        '''
+        Work out, for each of the hooks called every cycle, which modules and
+        extensions override the base class stub. The others are skipped by the
+        main loop instead of being called (and raising, or just returning) on
+        every pass. Call this again after changing `modules` or `extensions`
+        at runtime.
+        '''
+        self._module_hooks = {}
+        self._extension_hooks = {}
+        for hook in (
+            'before_matrix_scan',
+            'after_matrix_scan',
+            'before_hid_send',
+            'after_hid_send',
+        ):
+            stub = getattr(Module, hook)
+            self._module_hooks[hook] = [
+                _ for _ in self.modules if getattr(_.__class__, hook) is not stub
+            ]
+            stub = getattr(Extension, hook)
+            self._extension_hooks[hook] = [
+                _ for _ in self.extensions if getattr(_.__class__, hook) is not stub
+            ]
+
+        if debug.enabled:
+            for hook, modules in self._module_hooks.items():
+                debug(
+                    hook,
+                    '=',
+                    [_.__class__.__name__ for _ in modules],
+                    [_.__class__.__name__ for _ in self._extension_hooks[hook]],
+                )
+
     def before_matrix_scan(self) -> None:
-        for module in self.modules:
+        for module in self._module_hooks['before_matrix_scan']:
             try:
                 module.before_matrix_scan(self)
             except Exception as err:
                 debug_error(module, 'before_matrix_scan', err)
 
-        for ext in self.extensions:
+        for ext in self._extension_hooks['before_matrix_scan']:
             try:
                 ext.before_matrix_scan(self.sandbox)
             except Exception as err:
                 debug_error(ext, 'before_matrix_scan', err)
 
     def after_matrix_scan(self) -> None:
-        for module in self.modules:
+        for module in self._module_hooks['after_matrix_scan']:
             try:
                 module.after_matrix_scan(self)
             except Exception as err:
                 debug_error(module, 'after_matrix_scan', err)
 
-        for ext in self.extensions:
+        for ext in self._extension_hooks['after_matrix_scan']:
             try:
                 ext.after_matrix_scan(self.sandbox)
             except Exception as err:
                 debug_error(ext, 'after_matrix_scan', err)
 
     def before_hid_send(self) -> None:
-        for module in self.modules:
+        for module in self._module_hooks['before_hid_send']:
             try:
                 module.before_hid_send(self)
             except Exception as err:
                 debug_error(module, 'before_hid_send', err)
 
-        for ext in self.extensions:
+        for ext in self._extension_hooks['before_hid_send']:
             try:
                 ext.before_hid_send(self.sandbox)
             except Exception as err:
                 debug_error(ext, 'before_hid_send', err)
 
     def after_hid_send(self) -> None:
-        for module in self.modules:
+        for module in self._module_hooks['after_hid_send']:
             try:
                 module.after_hid_send(self)
             except Exception as err:
                 debug_error(module, 'after_hid_send', err)
 
-        for ext in self.extensions:
+        for ext in self._extension_hooks['after_hid_send']:
             try:
                 ext.after_hid_send(self.sandbox)
             except Exception as err:
@@ -472,6 +688,8 @@ class KMKKeyboard:
         try:
             while True:
                 self._main_loop()
+                if self.idle_sleep:
+                    self._idle()
         finally:
             debug('Unexpected error: cleaning up')
             self._deinit_hid()
@@ -495,6 +713,7 @@ class KMKKeyboard:
         self._init_matrix()
         self._init_coord_mapping()
         self.during_bootup()
+        self._init_coord_index()
 
         if debug.enabled:
             import gc
@@ -509,11 +728,9 @@ class KMKKeyboard:
 
         self._process_resume_buffer()
 
-        for matrix in self.matrix:
-            update = matrix.scan_for_changes()
-            if update:
-                self.matrix_update = update
-                break
+        update = self._scan_matrix()
+        if update:
+            self.matrix_update = update
         self.sandbox.matrix_update = self.matrix_update
         self.sandbox.secondary_matrix_update = self.secondary_matrix_update
 
@@ -527,8 +744,11 @@ class KMKKeyboard:
             self.matrix_update_queue.append(self.matrix_update)
             self.matrix_update = None
 
+        if self.batch_matrix_events:
+            self._drain_matrix()
+            self._handle_matrix_queue()
         # only handle one key per cycle.
-        if self.matrix_update_queue:
+        elif self.matrix_update_queue:
             self._handle_matrix_report(self.matrix_update_queue.pop(0))
 
         self.before_hid_send()
@@ -10,7 +10,9 @@ class Module:
     consistant manner.
     '''
 
-    # The below methods should be implemented by subclasses
+    # The below methods should be implemented by subclasses. before_matrix_scan,
+    # after_matrix_scan, before_hid_send and after_hid_send are optional: the
+    # keyboard only calls them on modules that override them.
 
     def during_bootup(self, keyboard):
         raise NotImplementedError
@@ -127,6 +127,7 @@ class Layers(HoldTap):
         self._active_combo = None
         keyboard.active_layers.clear()
         keyboard.active_layers.insert(0, key.meta.layer)
+        keyboard.active_layers_changed()
 
     def _print_debug(self, keyboard):
         if debug.enabled:
@@ -141,6 +142,7 @@ class Layers(HoldTap):
         if self.combo_layers:
             self._activate_combo_layer(keyboard)
 
+        keyboard.active_layers_changed()
         self._print_debug(keyboard)
 
     def deactivate_layer(self, keyboard, layer):
@@ -160,6 +162,7 @@ class Layers(HoldTap):
         if self.combo_layers:
             self._deactivate_combo_layer(keyboard, layer)
 
+        keyboard.active_layers_changed()
         self._print_debug(keyboard)
 
     def _activate_combo_layer(self, keyboard):
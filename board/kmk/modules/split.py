@@ -348,6 +348,10 @@ class Split(Module):
                 update = self._deserialize_update(self._uart.read(2))
                 self._uart_buffer.append(update)
             if self._uart_buffer:
+                if keyboard.batch_matrix_events:
+                    # Queue all but the newest; that one goes the usual way.
+                    keyboard.matrix_update_queue.extend(self._uart_buffer[:-1])
+                    del self._uart_buffer[:-1]
                 keyboard.secondary_matrix_update = self._uart_buffer.pop(0)
 
     def _checksum(self, update):
@@ -381,4 +385,8 @@ class Split(Module):
                     if self._checksum(update) == self._uart.read(1):
                         self._uart_buffer.append(self._deserialize_update(update))
             if self._uart_buffer:
+                if keyboard.batch_matrix_events:
+                    # Queue all but the newest; that one goes the usual way.
+                    keyboard.matrix_update_queue.extend(self._uart_buffer[:-1])
+                    del self._uart_buffer[:-1]
                 keyboard.secondary_matrix_update = self._uart_buffer.pop(0)
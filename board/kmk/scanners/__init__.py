@@ -33,6 +33,13 @@ class Scanner:
     def key_count(self):
         raise NotImplementedError
 
+    def events_pending(self):
+        '''
+        Whether scan_for_changes has something to report. Scanners that can't
+        tell without scanning say yes, which keeps the keyboard from idling.
+        '''
+        return True
+
     def scan_for_changes(self):
         '''
         Scan for key events and return a key report if an event exists.
@@ -15,6 +15,9 @@ class KeypadScanner(Scanner):
     def key_count(self):
         return self.keypad.key_count
 
+    def events_pending(self):
+        return bool(self.keypad.events)
+
     def scan_for_changes(self):
         '''
         Scan for key events and return a key report if an event exists.
@@ -6,7 +6,7 @@ module; it does however implement a pairing-heap for `TaskQueue` in native code.
 '''
 
 try:
-    from typing import Callable
+    from typing import Callable, Optional
 except ImportError:
     pass
 
@@ -69,6 +69,17 @@ def get_due_task() -> [Callable, None]:
         yield t.coro
 
 
+def get_next_deadline() -> Optional[int]:
+    '''
+    Milliseconds until the next task is due (0 if one already is), or None if
+    nothing is scheduled.
+    '''
+    t = _task_queue.peek()
+    if not t:
+        return None
+    return max(ticks_diff(t.ph_key, ticks_ms()), 0)
+
+
 def cancel_task(t: [Task, PeriodicTaskMeta]) -> None:
     if isinstance(t, PeriodicTaskMeta):
         t = t._task
@@ -96,6 +96,11 @@ irHandler.map = { # Note that transparent keys don't work on the mapping here, e
                  "90B47": (KC.N0, send_string("...0?"), send_string("zero"), SEND_IR_CODE),
 }
 
+# Instead of typing codes in above, you can learn them: give the entry a name starting with "@"
+# (e.g. "@MUTE": (KC.MUTE, KC.MUTE, KC.MUTE, KC.MUTE)), put irHandler.learnIRKey in the keymap (or
+# the map), press it, and press each button it asks for a few times.  The codes are kept in
+# /ircodes.bin, which is only writable when the CIRCUITPY drive isn't mounted (see boot.py).
+
 keyboard.debug_enabled = True
 
 if __name__ == '__main__':
@@ -0,0 +1,338 @@
+# Replays IR captures through IRModule on a normal computer, so decoder changes can be checked
+# for speed and correctness without flashing a board.
+#
+#   python tools/irbench/irbench.py                      # every .jsonl in corpus/
+#   python tools/irbench/irbench.py --protocols          # with the fixed-timing decoders on
+#   python tools/irbench/irbench.py --batch some.jsonl   # the original decode-at-the-end path
+#
+# Each line of a capture file is one button press:
+#   {"remote": ..., "protocol": ..., "button": ...,
+#    "expect": {"generic": "490", "protocols": "92"},   # hex codes, either can be null
+#    "pulses": [2400, -600, 1200, ...],                   # microseconds, marks +, spaces -
+#    "repeatPulses": [...],                              # optional: what's sent while held
+#    "repeats": 2, "periodMs": 45}                        # extra frames, and start-to-start spacing
+#
+# pulseio, supervisor and microcontroller are replaced by the stand-ins in stubs/, and time is
+# virtual: pulses land in PulseIn when they'd have finished arriving, and ir.service() is
+# called every --loop-ms of virtual time, the way the KMK main loop would.  CPU time is real.
+#
+# After the captures, the first one that decodes is also played through IR_Handler mapped to
+# KC.HT(A, B) (a single frame should tap A, a held button hold B), to KC.LT, as the start of a
+# sequence that never finishes, and as a typematic key, and with three receivers all picking it up.
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "stubs"), os.path.join(here, "..", "..", "board")]
+
+import microcontroller
+import pulseio
+import supervisor
+
+import IRModule
+from kmk.keys import KC
+from kmk.modules.layers import Layers
+from kmk.scheduler import cancel_task, create_task, get_due_task
+
+Layers() # registers KC.HT, KC.LT and KC.MO
+
+def timeline(capture):
+    # (arrival time in us, duration) for every pulse, in order, frames spaced by periodMs.
+    frames = [capture["pulses"]]
+    repeat = capture.get("repeatPulses", capture["pulses"])
+    frames += [repeat] * capture.get("repeats", 0)
+    periodUs = capture.get("periodMs", 100) * 1000
+    out = []
+    t = 0
+    frameStart = 0
+    for frame in frames:
+        if (out):
+            # the gap before this frame is a space PulseIn only records once this mark starts
+            gap = max(frameStart - t, 10000)
+            t += gap
+            out.append((t, gap))
+            frameStart = t
+        for value in frame:
+            t += abs(value)
+            out.append((t, abs(value)))
+        frameStart += periodUs
+    return out, len(frames)
+
+def replay(capture, args, trace=False):
+    supervisor.reset()
+    pulseio.PulseIn.instances.clear()
+    receiver = IRModule.ir(
+        microcontroller.pin.GPIO25,
+        streaming=not args.batch,
+        protocols=IRModule.PROTOCOLS if args.protocols else (),
+    )
+    receiver.pulseBudget = args.budget
+    receiver.dropPolicy = args.policy
+    pulseIn = pulseio.PulseIn.instances[-1]
+    pulses, frames = timeline(capture)
+    events = []
+    cpuNs = 0
+    peakBytes = 0
+    i = 0
+    if (trace):
+        # Only count what happens while running, not the buffers set up at boot.
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    endMs = pulses[-1][0] // 1000 + 500 # leave time for the release
+    while (supervisor.now < endMs):
+        supervisor.advance(args.loop_ms)
+        nowUs = supervisor.now * 1000
+        while (i < len(pulses)) and (pulses[i][0] <= nowUs):
+            pulseIn.push(pulses[i][1])
+            i += 1
+        start = time.perf_counter_ns()
+        queue = receiver.service()
+        cpuNs += time.perf_counter_ns() - start
+        while (queue):
+            code = queue.popleft()
+            events.append((queue.kind, code))
+    if (trace):
+        peakBytes = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    return events, frames, cpuNs, peakBytes
+
+class Keyboard:
+    # Just enough of KMKKeyboard for IR_Handler: keys are pressed the same way (so layer keys
+    # work), and instead of a HID report going out, what's held is noted down in reports.
+    def __init__(self):
+        self.active_layers = [0]
+        self.modules = []
+        self.keys_pressed = set()
+        self.hid_pending = False
+        self.log = []
+        self.reports = [] # (ms, keys held) for every report that would have been sent
+    def add_key(self, key):
+        self.log.append(("press", key))
+        self.keys_pressed.add(key)
+        key.on_press(self)
+    def remove_key(self, key):
+        self.log.append(("release", key))
+        self.keys_pressed.discard(key)
+        key.on_release(self)
+    def tap_key(self, key):
+        self.add_key(key)
+        self.set_timeout(0, lambda: self.remove_key(key))
+    def set_timeout(self, ms, callback):
+        return create_task(callback, after_ms=ms)
+    def cancel_timeout(self, task):
+        cancel_task(task)
+    def active_layers_changed(self):
+        pass
+    def send(self):
+        if (self.hid_pending):
+            self.reports.append((supervisor.now, set(self.keys_pressed)))
+            self.hid_pending = False
+    def sent(self, key):
+        # When each report with key in it (and the one before without) went out
+        return [ms for n, (ms, keys) in enumerate(self.reports) if (key in keys) and ((n == 0) or (key not in self.reports[n - 1][1]))]
+
+def handlerReplay(capture, args, repeats, keys, setup=None, receivers=1, loopMs=None):
+    # Plays a capture through IR_Handler with its code mapped to keys, the way KMK's main loop
+    # would: before_matrix_scan, a report, the due scheduler tasks, another report, after_hid_send.
+    # With receivers > 1, every receiver picks up every pulse.
+    supervisor.reset()
+    pulseio.PulseIn.instances.clear()
+    handler = IRModule.IR_Handler()
+    handler.pins = [getattr(microcontroller.pin, "GPIO%d" % (25 - n)) for n in range(receivers)]
+    handler.streaming = not args.batch
+    handler.protocols = IRModule.PROTOCOLS if args.protocols else ()
+    handler.map = {capture["expect"]["protocols" if args.protocols else "generic"]: keys}
+    keyboard = Keyboard()
+    if (setup is not None):
+        setup(handler, keyboard)
+    handler.during_bootup(keyboard)
+    pulseIns = pulseio.PulseIn.instances[-receivers:]
+    pulses, _ = timeline(dict(capture, repeats=repeats))
+    i = 0
+    endMs = pulses[-1][0] // 1000 + 800
+    while (supervisor.now < endMs):
+        supervisor.advance(loopMs or args.loop_ms)
+        nowUs = supervisor.now * 1000
+        while (i < len(pulses)) and (pulses[i][0] <= nowUs):
+            for pulseIn in pulseIns:
+                pulseIn.push(pulses[i][1])
+            i += 1
+        handler.before_matrix_scan(keyboard)
+        keyboard.send()
+        for task in get_due_task():
+            task()
+        keyboard.send()
+        handler.after_hid_send(keyboard)
+    return keyboard, handler
+
+def holdTap(capture, args, repeats, tapTime=None):
+    # A KC.HT(A, B) button pressed for one frame (should tap A) or held for a few (should hold B),
+    # in a report of its own either way.  With tapTime, the keyboard's HoldTap module has that
+    # tap_time, and a hold shorter than it should tap A instead.
+    tap = KC.A
+    hold = KC.B
+    def setup(handler, keyboard):
+        if (tapTime is not None):
+            module = Layers()
+            module.tap_time = tapTime
+            keyboard.modules.append(module)
+    keyboard, _ = handlerReplay(capture, args, repeats, (KC.HT(tap, hold),), setup)
+    want = hold if (repeats) and (tapTime is None) else tap
+    sent = len(keyboard.sent(want)) == 1
+    return (keyboard.log == [("press", want), ("release", want)]) and sent, keyboard.log + [("reports", keyboard.reports)]
+
+def layerTap(capture, args, repeats):
+    # A KC.LT(1, A) button held for a few frames: layer 1 should be on while it's held, and gone
+    # once it's let go (even though the code means something else on layer 1).
+    keyboard, _ = handlerReplay(capture, args, repeats, (KC.LT(1, KC.A), KC.C))
+    presses = [key for ev, key in keyboard.log if (ev == "press")]
+    ok = (len(presses) == 1) and (keyboard.log[-1] == ("release", presses[0])) and (keyboard.active_layers == [0])
+    return ok, keyboard.log + [("layers", keyboard.active_layers)]
+
+def sequenceTap(capture, args, repeats, finish):
+    # A button that starts a sequence, then nothing: once sequenceTimeout's up it should tap its
+    # own key (A) - or with finish, B for the one-button sequence it also completes - in a report.
+    code = capture["expect"]["protocols" if args.protocols else "generic"]
+    other = "%X" % (int(code, 16) ^ 1) # a next button that never comes
+    def setup(handler, keyboard):
+        handler.sequences = {(code, other): (KC.C,)}
+        if (finish):
+            handler.sequences[(code,)] = (KC.B,)
+        handler.sequenceTimeout = 300
+    keyboard, _ = handlerReplay(capture, args, repeats, (KC.A,), setup)
+    want = KC.B if (finish) else KC.A
+    ok = (keyboard.log == [("press", want), ("release", want)]) and (len(keyboard.sent(want)) == 1)
+    return ok, keyboard.log + [("reports", keyboard.reports)]
+
+def multiReceiver(capture, args, repeats):
+    # A held button picked up by three receivers, on a main loop slow enough that each one is
+    # serviced well after the others: still one press and one release, and the repeat period
+    # learned from the frames, not from the gaps between receivers.
+    key = KC.A
+    keyboard, handler = handlerReplay(capture, args, repeats, (key,), receivers=3, loopMs=12)
+    period = handler.ir.repeatPeriod
+    ok = (keyboard.log == [("press", key), ("release", key)]) and (period > capture.get("periodMs", 100) // 2)
+    return ok, keyboard.log + [("repeatPeriod", period)]
+
+def typematic(capture, args, repeats):
+    # A typematic button held for a few frames: it should tap more than once, every tap should
+    # reach a report, and it should stop within a repeat period of the last frame.
+    key = KC.A
+    def setup(handler, keyboard):
+        handler.typematic = tuple(handler.map)
+    keyboard, handler = handlerReplay(capture, args, repeats, (key,), setup)
+    lastMs = handler.ir.lastDecodeTicks
+    taps = keyboard.sent(key)
+    presses = sum(1 for ev, k in keyboard.log if (ev == "press"))
+    limit = lastMs + capture.get("periodMs", 100) * 5 // 4 + args.loop_ms # tasks run a loop late at most
+    ok = (len(taps) > 2) and (len(taps) == presses) and (taps[-1] <= limit)
+    return ok, ["%d taps, %d sent, last at %dms (last frame decoded at %dms)" % (presses, len(taps), taps[-1] if taps else -1, lastMs)]
+
+def decodeOnly(capture, args, rounds=200):
+    # Just the decoder, fed a whole frame: the part that used to happen on a button press.
+    values = capture["pulses"]
+    if (args.batch):
+        start = time.perf_counter_ns()
+        for _ in range(rounds):
+            IRModule.decode(list(values))
+        return (time.perf_counter_ns() - start) // rounds
+    decoder = IRModule.StreamDecoder(protocols=IRModule.PROTOCOLS if args.protocols else ())
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        decoder.start(values[0])
+        for value in values[1:]:
+            decoder.feed(value)
+        decoder.finish()
+    return (time.perf_counter_ns() - start) // rounds
+
+def allocations(capture, args):
+    # Peak bytes allocated while replaying (CPython's allocator, not the board's, but the trend is what matters).
+    return replay(capture, args, trace=True)[3]
+
+def expected(capture, args):
+    code = capture.get("expect", {}).get("protocols" if args.protocols else "generic")
+    return None if (code is None) else int(code, 16)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay IR captures through IRModule")
+    parser.add_argument("captures", nargs="*", help="capture files (default: corpus/*.jsonl)")
+    parser.add_argument("--batch", action="store_true", help="use the original decode-at-the-end path")
+    parser.add_argument("--protocols", action="store_true", help="turn on the fixed-timing protocol decoders")
+    parser.add_argument("--loop-ms", type=int, default=1, help="virtual time between service() calls")
+    parser.add_argument("--budget", type=int, default=100, help="pulses per service() call (0 = no limit)")
+    parser.add_argument("--policy", default="full", choices=("full", "skip", "oldest"), help="what to do past the budget")
+    parser.add_argument("--alloc", action="store_true", help="also measure allocations (slow)")
+    parser.add_argument("--strict", action="store_true", help="exit non-zero if any capture decodes wrong")
+    args = parser.parse_args()
+
+    files = args.captures or sorted(glob.glob(os.path.join(here, "corpus", "*.jsonl")))
+    captures = []
+    for path in files:
+        with open(path) as fp:
+            captures += [json.loads(line) for line in fp if line.strip()]
+
+    checked = 0
+    correct = 0
+    totalFrames = 0
+    totalNs = 0
+    for capture in captures:
+        events, frames, cpuNs, _ = replay(capture, args)
+        presses = [code for ev, code in events if ev == "press"]
+        want = expected(capture, args)
+        if (want is None):
+            verdict = "n/a"
+        else:
+            checked += 1
+            # One press of the right code, and a release at the end
+            ok = (presses == [want]) and (events[-1] == ("release", want))
+            correct += ok
+            verdict = "ok" if ok else "WRONG"
+        totalFrames += frames
+        totalNs += cpuNs
+        line = "%-12s %-10s %-8s %-6s %8.1f us/frame %8.1f us/decode" % (
+            capture.get("remote", "?"), capture.get("protocol", "?"), capture.get("button", "?"),
+            verdict, cpuNs / frames / 1000, decodeOnly(capture, args) / 1000,
+        )
+        if (args.alloc):
+            line += " %8d B peak" % allocations(capture, args)
+        if (verdict == "WRONG"):
+            line += "  got " + " ".join("%s %X" % (ev, code) for ev, code in events)
+        print(line)
+
+    # Hold-tap: a quick press and a long one, on the first capture that decodes at all
+    for capture in captures:
+        if (expected(capture, args) is None):
+            continue
+        for check, repeats, label in (
+            (holdTap, 0, "HT tap"),
+            (holdTap, 6, "HT hold"),
+            (lambda *a: holdTap(*a, tapTime=2000), 6, "HT slow"),
+            (layerTap, 6, "LT hold"),
+            (lambda *a: sequenceTap(*a, finish=False), 0, "seq lone"),
+            (lambda *a: sequenceTap(*a, finish=True), 0, "seq short"),
+            (typematic, 6, "typematic"),
+            (multiReceiver, 6, "3 receivers"),
+        ):
+            ok, log = check(capture, args, repeats)
+            checked += 1
+            correct += ok
+            line = "%-12s %-10s %-8s %-6s" % (capture.get("remote", "?"), capture.get("protocol", "?"), label, "ok" if ok else "WRONG")
+            if (not ok):
+                line += "  got " + " ".join(str(entry) for entry in log)
+            print(line)
+        break
+
+    print()
+    print("accuracy: %d/%d   service() cpu: %.1f us/frame over %d frames" % (
+        correct, checked, totalNs / max(totalFrames, 1) / 1000, totalFrames,
+    ))
+    if (args.strict) and (correct != checked):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# Host stand-in for the bits of CircuitPython's native _asyncio that kmk.scheduler uses: a Task
+# is just a callable with a sort key, and the queue a sorted list (small enough not to matter).
+from supervisor import ticks_ms
+
+from kmk.kmktime import ticks_diff
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.ph_key = 0
+
+class TaskQueue:
+    def __init__(self):
+        self.tasks = []
+
+    def peek(self):
+        return self.tasks[0] if self.tasks else None
+
+    def push_sorted(self, task, key=None):
+        if (key is not None):
+            task.ph_key = key
+        i = 0
+        while (i < len(self.tasks)) and (ticks_diff(self.tasks[i].ph_key, task.ph_key) <= 0):
+            i += 1
+        self.tasks.insert(i, task)
+
+    def push_head(self, task):
+        task.ph_key = ticks_ms()
+        self.tasks.insert(0, task)
+
+    def pop_head(self):
+        return self.tasks.pop(0)
+
+    def remove(self, task):
+        self.tasks.remove(task)
@@ -0,0 +1,12 @@
+# Host stand-in for CircuitPython's microcontroller module: just enough pins to construct things.
+class Pin:
+    def __init__(self, name: str):
+        self.name = name
+    def __repr__(self):
+        return "board." + self.name
+
+class pin:
+    pass
+
+for _n in range(30):
+    setattr(pin, "GPIO%d" % _n, Pin("GPIO%d" % _n))
@@ -0,0 +1,3 @@
+# Host stand-in for CircuitPython's micropython module.
+def const(value):
+    return value
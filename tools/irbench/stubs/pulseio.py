@@ -0,0 +1,59 @@
+# Host stand-in for CircuitPython's pulseio.  PulseIn is a plain queue of durations the
+# harness pushes into as virtual time passes.
+class PulseIn:
+    instances = []
+
+    def __init__(self, pin, maxlen: int = 2, idle_state: bool = False):
+        self.pin = pin
+        self.maxlen = maxlen
+        self.idle_state = idle_state
+        self.values = []
+        self.dropped = 0
+        PulseIn.instances.append(self)
+
+    def push(self, duration: int):
+        if (len(self.values) >= self.maxlen):
+            self.dropped += 1 # the real thing stops recording when it's full
+            return
+        self.values.append(min(duration, 65535))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index: int):
+        return self.values[index]
+
+    def popleft(self):
+        return self.values.pop(0)
+
+    def clear(self):
+        self.values.clear()
+
+    def pause(self):
+        pass
+
+    def resume(self, trigger_duration: int = 0):
+        pass
+
+    def deinit(self):
+        pass
+
+class PulseOut:
+    # Records what was sent, with the virtual time it went out, and (like the real one) doesn't
+    # return until it would have finished.
+    instances = []
+
+    def __init__(self, pin, frequency: int = 38000, duty_cycle: int = 1 << 15):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = duty_cycle
+        self.sent = []
+        PulseOut.instances.append(self)
+
+    def send(self, pulses):
+        import supervisor
+        self.sent.append((supervisor.now, list(pulses)))
+        supervisor.advance((sum(pulses) + 999) // 1000)
+
+    def deinit(self):
+        pass
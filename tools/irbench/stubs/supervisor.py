@@ -0,0 +1,20 @@
+# Host stand-in for CircuitPython's supervisor module, driven by a virtual clock so
+# replays are deterministic and don't depend on how fast the host is.
+_TICKS_PERIOD = 1 << 29
+
+now = 0 # virtual milliseconds since "boot"
+
+def ticks_ms():
+    return now % _TICKS_PERIOD
+
+def advance(ms: int):
+    global now
+    now += ms
+
+def reset():
+    global now
+    now = 0
+
+class runtime:
+    usb_connected = True
+    serial_connected = False